@@ -0,0 +1,6 @@
+# License info goes here.
+
+"""
+Package: benchmarks
+Micro-benchmarks for the patient membership service
+"""
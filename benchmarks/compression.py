@@ -0,0 +1,74 @@
+# License info goes here.
+
+"""
+Benchmark of response compression on patient list payloads
+
+Measures the CPU time and the bytes saved by each available encoding at a
+few levels, on JSON and NDJSON bodies built from the sample patient records.
+
+Run it from the repository root with (importing the service package sets up
+the database, so any reachable DATABASE_URI will do):
+    DATABASE_URI=sqlite:// python -m benchmarks.compression [rows]
+"""
+import sys
+import json
+import time
+from service.compression import GzipCompressor, BrotliCompressor, ZstdCompressor, brotli, zstandard
+
+LEVELS = {
+    GzipCompressor: [1, 6, 9],
+    BrotliCompressor: [1, 4, 9],
+    ZstdCompressor: [1, 3, 9],
+}
+
+
+def patient_records(rows):
+    """ Builds a realistic patient list by varying the sample records """
+    with open("tests/records.json") as jsonfile:
+        samples = json.load(jsonfile)
+    records = []
+    for i in range(rows):
+        record = dict(samples[i % len(samples)], id=i + 1)
+        record["street"] = "{} {}".format(100 + i % 9000, record["street"].split(" ", 1)[1])
+        record["phone_home"] = "({}) 555-{:04d}".format(record["phone_home"][1:4], i % 10000)
+        records.append(record)
+    return records
+
+
+def measure(compressor_class, level, chunks, repeat=3):
+    """ Returns the best compression time and the compressed size """
+    best, size = None, 0
+    for _ in range(repeat):
+        compressor = compressor_class(level)
+        start = time.perf_counter()
+        size = sum(len(compressor.compress(chunk)) for chunk in chunks) + len(compressor.flush())
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main(rows):
+    records = patient_records(rows)
+    bodies = {
+        "json": [json.dumps(records).encode("utf-8")],
+        "ndjson": [(json.dumps(record) + "\n").encode("utf-8") for record in records],
+    }
+    compressors = [GzipCompressor]
+    if brotli is not None:
+        compressors.append(BrotliCompressor)
+    if zstandard is not None:
+        compressors.append(ZstdCompressor)
+
+    print("{:>7} {:>6} {:>5} {:>12} {:>12} {:>7} {:>10}".format(
+        "body", "enc", "level", "raw bytes", "sent bytes", "ratio", "ms"))
+    for name, chunks in bodies.items():
+        raw = sum(len(chunk) for chunk in chunks)
+        for compressor_class in compressors:
+            for level in LEVELS[compressor_class]:
+                elapsed, size = measure(compressor_class, level, chunks)
+                print("{:>7} {:>6} {:>5} {:>12} {:>12} {:>7.2f} {:>10.1f}".format(
+                    name, compressor_class.encoding, level, raw, size, raw / size, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,54 @@
+# License info goes here.
+
+"""
+Benchmark of the patient list assembled from stored JSON documents
+
+Times GET /pats over the whole table (100,000 rows by default) serialized
+from the loaded Pats, as it is done without JSON_DOCUMENTS_ENABLED, against
+the same list assembled from the stored documents. The documents are
+written by the "doc" backfill, the way an existing table gets them.
+
+Run it from the repository root with:
+    DATABASE_URI=sqlite:// python -m benchmarks.documents [rows] [calls]
+"""
+import sys
+import time
+import logging
+from service import app, backfill
+from service.models import Pat, db
+from benchmarks.finders import populate
+
+
+def per_call(client, url, calls, headers=None):
+    """ Returns the mean time of a request in milliseconds and the response size """
+    resp = client.get(url, headers=headers)  # warm up the caches
+    assert resp.status_code == 200
+    start = time.perf_counter()
+    for _ in range(calls):
+        client.get(url, headers=headers)
+    return (time.perf_counter() - start) / calls * 1000, len(resp.data)
+
+
+def main(rows, calls):
+    app.logger.setLevel(logging.CRITICAL)
+    app.config["RATE_LIMIT_ENABLED"] = False
+    client = app.test_client()
+    db.drop_all()
+    db.create_all()
+    populate(rows)
+    backfill.run("doc", batch_size=5000, sleep=0)
+    cases = [("JSON", None), ("NDJSON", {"Accept": "application/x-ndjson"})]
+    print("{:>8} {:>10} {:>10} {:>12}".format("format", "path", "ms/call", "bytes"))
+    for name, headers in cases:
+        for path, documents in (("serialize", False), ("documents", True)):
+            Pat.documents = documents
+            elapsed, size = per_call(client, "/pats", calls, headers)
+            print("{:>8} {:>10} {:>10.1f} {:>12}".format(name, path, elapsed, size))
+    Pat.documents = app.config["JSON_DOCUMENTS_ENABLED"]
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 3,
+    )
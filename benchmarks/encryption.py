@@ -0,0 +1,53 @@
+# License info goes here.
+
+"""
+Benchmark of the field level encryption on the patient list
+
+Measures GET /pats with all the fields and with fields=id,state (the
+encrypted columns are then not loaded, so not decrypted) with encryption
+off and on. A random key is used, nothing is stored.
+
+Run it from the repository root with:
+    DATABASE_URI=sqlite:// python -m benchmarks.encryption [rows] [calls]
+"""
+import os
+import sys
+import time
+import base64
+import logging
+from service import app
+from service.encryption import keyring
+from service.models import db
+from benchmarks.finders import populate
+
+
+def per_call(client, url, calls):
+    """ Returns the mean time of a request in milliseconds """
+    assert client.get(url).status_code == 200  # warm up the caches
+    start = time.perf_counter()
+    for _ in range(calls):
+        client.get(url)
+    return (time.perf_counter() - start) / calls * 1000
+
+
+def main(rows, calls):
+    app.logger.setLevel(logging.CRITICAL)
+    app.config["RATE_LIMIT_ENABLED"] = False
+    client = app.test_client()
+    urls = ["/pats", "/pats?fields=id,state"]
+    print("{:>12} {:>22} {:>10}".format("encryption", "url", "ms/call"))
+    for keys in ([], [("bench", base64.b64encode(os.urandom(32)).decode("ascii"))]):
+        keyring.configure(keys)
+        db.drop_all()
+        db.create_all()
+        populate(rows)
+        for url in urls:
+            print("{:>12} {:>22} {:>10.2f}".format("on" if keys else "off", url, per_call(client, url, calls)))
+    keyring.configure(app.config["FIELD_ENCRYPTION_KEYS"])
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    )
@@ -0,0 +1,74 @@
+# License info goes here.
+
+"""
+Micro-benchmark of the Pat finders
+
+Compares the per call time of find, find_by_lname and find_by_zip with the
+cached (baked) statements against building a fresh Query on every call, the
+way the finders used to work. An in-memory SQLite database keeps the numbers
+about Python overhead rather than I/O.
+
+Run it from the repository root with:
+    DATABASE_URI=sqlite:// python -m benchmarks.finders [calls]
+"""
+import sys
+import json
+import time
+import logging
+from datetime import datetime
+from service import app
+from service.models import Pat, Gender, db
+
+
+def populate(rows=1000):
+    """ Fills the database with patients built from the sample records """
+    with open("tests/records.json") as jsonfile:
+        samples = json.load(jsonfile)
+    for i in range(rows):
+        record = samples[i % len(samples)]
+        # unique names and zip codes so that each query returns one row
+        db.session.add(Pat(
+            fname=record["fname"], lname="{}{}".format(record["lname"], i),
+            street=record["street"], postal_code="{:05d}".format(i), city=record["city"],
+            state=record["state"][:2], phone_home=record["phone_home"], email=record["email"],
+            DOB=datetime.strptime(record["DOB"], "%Y-%m-%d"), gender=Gender[record["sex"]],
+        ))
+    db.session.commit()
+
+
+def per_call(function, calls):
+    """ Returns the mean time of a call in microseconds """
+    function()  # warm up the caches
+    elapsed = 0
+    for _ in range(calls):
+        # forget the loaded patients so that every call runs its query
+        db.session.expunge_all()
+        start = time.perf_counter()
+        function()
+        elapsed += time.perf_counter() - start
+    db.session.remove()
+    return elapsed / calls * 1000000
+
+
+def main(calls):
+    app.logger.setLevel(logging.CRITICAL)
+    db.drop_all()
+    db.create_all()
+    populate()
+    cases = [
+        ("find", lambda: Pat.query.get(500), lambda: Pat.find(500)),
+        ("find_by_lname",
+         lambda: Pat.query.filter(Pat.lname == "Cohen1").all(),
+         lambda: Pat.find_by_lname("Cohen1")),
+        ("find_by_zip",
+         lambda: Pat.query.filter(Pat.postal_code == "00500").all(),
+         lambda: Pat.find_by_zip("00500")),
+    ]
+    print("{:>15} {:>14} {:>14}".format("finder", "fresh us/call", "baked us/call"))
+    for name, fresh, cached in cases:
+        print("{:>15} {:>14.1f} {:>14.1f}".format(name, per_call(fresh, calls), per_call(cached, calls)))
+    print("statement cache:", Pat.statements.stats())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,158 @@
+# License info goes here.
+
+"""
+Benchmark of the gunicorn worker profiles
+
+Starts gunicorn with each profile of gunicorn.conf.py (and sync and
+gthread without preload), drives it with concurrent clients reading single
+patients and state lists for a while, and reports the throughput and the
+memory of the master and its workers: RSS counts the pages shared
+copy-on-write once per process, PSS splits them among the processes that
+share them, so the preload gain shows as a lower PSS. Profiles whose worker
+class is not installed (gevent) are skipped.
+
+It needs Linux (/proc) and a database the processes share, a SQLite file
+is created when DATABASE_URI is not set. Run it from the repository root with:
+    python -m benchmarks.gunicorn [seconds] [clients] [workers]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from urllib.error import URLError
+
+PORT = 5099
+STATES = ["CA", "NY", "TX", "FL", "IL", "PA", "OH", "GA", "NC", "MI"]
+CASES = [
+    ("sync", "true"),
+    ("sync", "false"),
+    ("gthread", "true"),
+    ("gthread", "false"),
+    ("gevent", "false"),
+]
+
+
+def populate(env, rows=2000):
+    """ Fills the database once, in a process of its own """
+    script = (
+        "from service import app\n"
+        "from service.models import Pat, db\n"
+        "from benchmarks.finders import populate\n"
+        "db.drop_all()\n"
+        "db.create_all()\n"
+        "populate({})\n"
+        "for number, pat in enumerate(Pat.query.all()):\n"
+        "    pat.state = {!r}[number % {}]\n"
+        "db.session.commit()\n"
+    ).format(rows, STATES, len(STATES))
+    subprocess.run([sys.executable, "-c", script], env=env, check=True, stdout=subprocess.DEVNULL)
+    return rows
+
+
+def start(env):
+    """ Starts gunicorn and waits until it answers """
+    server = subprocess.Popen(
+        # gunicorn 20.0 has no __main__, run its script entry point with this interpreter
+        [sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()",
+         "--config", "gunicorn.conf.py", "service:app"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen("http://127.0.0.1:{}/".format(PORT), timeout=1).read()
+            return server
+        except (URLError, ConnectionError):
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def processes(master):
+    """ Returns the pid of the master and of its workers """
+    pids = [master]
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open("/proc/{}/stat".format(name)) as stat:
+                    if int(stat.read().rsplit(")", 1)[1].split()[1]) == master:
+                        pids.append(int(name))
+            except (OSError, IndexError, ValueError):
+                continue
+    return pids
+
+
+def memory(pids):
+    """ Returns the total RSS and PSS of processes in MiB """
+    rss = pss = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/smaps_rollup".format(pid)) as smaps:
+                for line in smaps:
+                    name, value = line.split(":", 1)
+                    if name == "Rss":
+                        rss += int(value.split()[0])
+                    elif name == "Pss":
+                        pss += int(value.split()[0])
+        except OSError:
+            continue
+    return rss / 1024, pss / 1024
+
+
+def drive(rows, seconds, clients):
+    """ Sends requests from several threads and returns the requests per second """
+    counts = [0] * clients
+    stop = time.monotonic() + seconds
+
+    def client(index):
+        rand = random.Random(index)
+        while time.monotonic() < stop:
+            if rand.random() < 0.8:
+                path = "/pats/{}".format(rand.randint(1, rows))
+            else:
+                path = "/pats?state={}&fields=id,lname".format(rand.choice(STATES))
+            urllib.request.urlopen("http://127.0.0.1:{}{}".format(PORT, path), timeout=30).read()
+            counts[index] += 1
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def main(seconds, clients, workers):
+    env = dict(os.environ, RATE_LIMIT_ENABLED="false", LOG_FORMAT="text",
+               GUNICORN_BIND="127.0.0.1:{}".format(PORT), GUNICORN_WORKERS=str(workers))
+    if "DATABASE_URI" not in env:
+        env["DATABASE_URI"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    rows = populate(env)
+    print("{:>8} {:>8} {:>10} {:>10} {:>10}".format("profile", "preload", "req/s", "RSS MiB", "PSS MiB"))
+    for profile, preload in CASES:
+        if profile == "gevent":
+            try:
+                import gevent  # pylint: disable=unused-import
+            except ImportError:
+                print("{:>8} {:>8} {:>10}".format(profile, preload, "skipped"))
+                continue
+        server = start(dict(env, GUNICORN_PROFILE=profile, GUNICORN_PRELOAD=preload))
+        try:
+            throughput = drive(rows, seconds, clients)
+            rss, pss = memory(processes(server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+        print("{:>8} {:>8} {:>10.0f} {:>10.1f} {:>10.1f}".format(profile, preload, throughput, rss, pss))
+
+
+if __name__ == "__main__":
+    main(
+        float(sys.argv[1]) if len(sys.argv) > 1 else 10,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 16,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 4,
+    )
@@ -19,5 +19,152 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Read replicas serving the reads of GET requests, comma separated URIs
+SQLALCHEMY_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+# Clients read from the primary for a while after they wrote
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+READ_YOUR_WRITES_MAX_CLIENTS = int(os.getenv("READ_YOUR_WRITES_MAX_CLIENTS", "10000"))
+# Cookie that keeps a writer on the primary whichever worker serves its next reads
+READ_YOUR_WRITES_COOKIE = os.getenv("READ_YOUR_WRITES_COOKIE", "read_primary_until")
+
+# Horizontal sharding of the pat table, comma separated URIs (none to disable)
+SQLALCHEMY_SHARD_URIS = [uri for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri]
+# "id" spreads new patients over the shards, "state" keeps each state on one shard
+SHARD_STRATEGY = os.getenv("SHARD_STRATEGY", "id")
+# Optional state to shard assignments, e.g. "CA:0,NY:1", other states are hashed
+SHARD_STATES = {
+    state: int(shard)
+    for state, shard in (item.split(":") for item in os.getenv("SHARD_STATES", "").split(",") if item)
+}
+# Worker number in the generated ids, must differ between processes (0-31),
+# required with shards. Under gunicorn.conf.py it is the first number of the
+# host, each worker adds a slot of its own
+ID_WORKER = int(os.getenv("ID_WORKER")) if os.getenv("ID_WORKER") else None
+
+# Store the pre-encoded JSON document of every patient next to its row, the
+# full patient lists are then assembled from the stored documents
+JSON_DOCUMENTS_ENABLED = os.getenv("JSON_DOCUMENTS_ENABLED", "false").lower() == "true"
+
+# Identical reads in flight at the same time in a worker share one database call
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+# /debug/single-flight is only served when turned on
+SINGLE_FLIGHT_DEBUG_ENDPOINT = os.getenv("SINGLE_FLIGHT_DEBUG_ENDPOINT", "false").lower() == "true"
+
+# Compiled finder statements kept in the cache
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "200"))
+# /debug/statement-cache is only served when turned on
+STATEMENT_CACHE_DEBUG_ENDPOINT = os.getenv("STATEMENT_CACHE_DEBUG_ENDPOINT", "false").lower() == "true"
+
+# Batch lookups: the most ids accepted per request and per IN query
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "1000"))
+BATCH_GET_CHUNK_SIZE = int(os.getenv("BATCH_GET_CHUNK_SIZE", "500"))
+
+# Response compression: bodies smaller than the minimum size are sent as is
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv("COMPRESSION_BROTLI_LEVEL", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+
+# Rate limiting: token buckets per client (identified by RATE_LIMIT_KEY_HEADER
+# or its address) kept in memory, or shared through a redis://, rediss:// or
+# unix:// storage URI. Off by default: behind a proxy every client without a
+# key has the proxy's address unless TRUSTED_PROXY_HOPS is set
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "X-API-Key")
+# Requests per second and burst size for each cost class
+RATE_LIMITS = {
+    "cheap": (
+        float(os.getenv("RATE_LIMIT_CHEAP_RATE", "50")),
+        int(os.getenv("RATE_LIMIT_CHEAP_BURST", "200")),
+    ),
+    "expensive": (
+        float(os.getenv("RATE_LIMIT_EXPENSIVE_RATE", "2")),
+        int(os.getenv("RATE_LIMIT_EXPENSIVE_BURST", "10")),
+    ),
+}
+# Requests of each cost class a worker runs at the same time
+CONCURRENCY_LIMITS = {
+    "cheap": int(os.getenv("CONCURRENCY_CHEAP_LIMIT", "64")),
+    "expensive": int(os.getenv("CONCURRENCY_EXPENSIVE_LIMIT", "2")),
+}
+CONCURRENCY_RETRY_AFTER = int(os.getenv("CONCURRENCY_RETRY_AFTER", "1"))
+# Proxies in front of the service (e.g. 1 behind the platform router), the
+# client address is taken from the X-Forwarded-For entry they appended. Leave
+# it 0 when clients reach the service directly, or they could pick their address
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+# SQL profiling, for every request or for those sending SQL_PROFILE_HEADER
+SQL_PROFILE_ENABLED = os.getenv("SQL_PROFILE_ENABLED", "false").lower() == "true"
+SQL_PROFILE_HEADER = os.getenv("SQL_PROFILE_HEADER", "X-Profile-SQL")
+# Value the header must carry, the header is ignored while no token is set
+SQL_PROFILE_TOKEN = os.getenv("SQL_PROFILE_TOKEN", "")
+# Statements slower than this get their EXPLAIN plan captured
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", "100"))
+# Profiled requests kept for /debug/queries, which shows SQL parameters and
+# so is only served when SQL_PROFILE_DEBUG_ENDPOINT is turned on
+SQL_PROFILE_BUFFER_SIZE = int(os.getenv("SQL_PROFILE_BUFFER_SIZE", "100"))
+SQL_PROFILE_DEBUG_ENDPOINT = os.getenv("SQL_PROFILE_DEBUG_ENDPOINT", "false").lower() == "true"
+
+# Logging: "json" or "text" lines, written by a background thread
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of the INFO lines kept per logger, e.g. "service.models:0.1"
+LOG_SAMPLE_RATES = {
+    name: float(rate)
+    for name, rate in (item.rsplit(":", 1) for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if item)
+}
+
+# Idempotency keys: how long responses are kept, and how many stay in memory
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# Seconds after which a request still in progress is presumed dead and retried
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+# Duplicate matching: the lowest similarity reported, and the largest block
+# of patients sharing a blocking key that the batch job still compares
+DUPLICATE_MIN_SCORE = float(os.getenv("DUPLICATE_MIN_SCORE", "0.5"))
+DUPLICATE_MAX_BLOCK_SIZE = int(os.getenv("DUPLICATE_MAX_BLOCK_SIZE", "100"))
+
+# Pages of the DOB range and age band queries on GET /pats
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "1000"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "10000"))
+
+# Bulk loader: worker processes (the CPU count when 0) and CSV rows per chunk
+LOADER_WORKERS = int(os.getenv("LOADER_WORKERS", "0")) or None
+LOADER_CHUNK_SIZE = int(os.getenv("LOADER_CHUNK_SIZE", "10000"))
+
+# Look up the mail servers of email addresses when validating them
+EMAIL_CHECK_DELIVERABILITY = os.getenv("EMAIL_CHECK_DELIVERABILITY", "true").lower() == "true"
+
+# Online backfills: rows per batch, pause between batches, and the
+# replication lag in seconds they wait for before the next batch
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "1000"))
+BACKFILL_SLEEP_SECONDS = float(os.getenv("BACKFILL_SLEEP_SECONDS", "0.1"))
+BACKFILL_MAX_REPLICA_LAG = float(os.getenv("BACKFILL_MAX_REPLICA_LAG", "5"))
+
+# Archival of deleted patients: days after deletion before a patient moves to
+# the archive table, rows per batch, pause between batches and replication lag
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_SLEEP_SECONDS = float(os.getenv("ARCHIVE_SLEEP_SECONDS", "0.1"))
+ARCHIVE_MAX_REPLICA_LAG = float(os.getenv("ARCHIVE_MAX_REPLICA_LAG", "5"))
+# include_archived returns the personal data of deleted patients, so it is only
+# honored on requests whose ARCHIVE_AUDIT_HEADER carries this token (never
+# while it is empty)
+ARCHIVE_AUDIT_HEADER = os.getenv("ARCHIVE_AUDIT_HEADER", "X-Audit-Token")
+ARCHIVE_AUDIT_TOKEN = os.getenv("ARCHIVE_AUDIT_TOKEN", "")
+
+# Field encryption keys as "id:base64 key" pairs, the first one encrypts new
+# values, e.g. "2024:<32+ random bytes in base64>,2023:<older key>"
+FIELD_ENCRYPTION_KEYS = [
+    tuple(item.strip().split(":", 1)) for item in os.getenv("FIELD_ENCRYPTION_KEYS", "").split(",") if item.strip()
+]
+# Decrypted values of the searchable columns kept in memory
+FIELD_ENCRYPTION_CACHE_SIZE = int(os.getenv("FIELD_ENCRYPTION_CACHE_SIZE", "10000"))
+
 # Secret for session management
 #SECRET_KEY = os.getenv("SECRET_KEY", "mysecretkey")
@@ -0,0 +1,106 @@
+# License info goes here.
+
+"""
+Gunicorn Settings
+
+Gunicorn reads this file from the working directory, or with
+    gunicorn --config gunicorn.conf.py service:app
+
+GUNICORN_PROFILE picks the worker model:
+
+sync - one request at a time per process, the default
+gthread - GUNICORN_THREADS threads per process, so that requests waiting on
+    the database overlap and identical reads are coalesced, with less memory
+    than as many processes
+gevent - greenlets for many slow or idle keepalive clients, needs gevent
+    (and psycogreen for PostgreSQL) and imports the app in each worker,
+    after gevent patched the standard library
+
+The other profiles preload the app in the master so that the workers share
+its code and data copy-on-write and start faster. The master closes its
+database connections before forking, and each worker drops what it
+inherited and starts its own log listener (see service.after_fork).
+GUNICORN_WORKERS, GUNICORN_THREADS, GUNICORN_KEEPALIVE and GUNICORN_PRELOAD
+override a profile.
+
+The workers generate the sharded ids with worker numbers of their own:
+ID_WORKER is the first number of the host and each worker adds the lowest
+slot no live worker holds, so a replaced worker reuses the slot of the one
+it replaces. The hosts need ranges of ID_WORKER that do not overlap.
+"""
+import os
+import sys
+import multiprocessing
+
+CPUS = multiprocessing.cpu_count()
+
+PROFILES = {
+    "sync": {"worker_class": "sync", "workers": 2 * CPUS + 1, "threads": 1, "preload_app": True},
+    "gthread": {"worker_class": "gthread", "workers": CPUS + 1, "threads": 4, "preload_app": True},
+    "gevent": {"worker_class": "gevent", "workers": CPUS + 1, "threads": 1, "preload_app": False},
+}
+
+profile_name = os.getenv("GUNICORN_PROFILE", "sync")
+if profile_name not in PROFILES:
+    raise RuntimeError("Unknown GUNICORN_PROFILE {}, use one of {}".format(profile_name, ", ".join(PROFILES)))
+profile = PROFILES[profile_name]
+
+bind = os.getenv("GUNICORN_BIND") or "0.0.0.0:{}".format(os.getenv("PORT", "5000"))
+worker_class = profile["worker_class"]
+workers = int(os.getenv("GUNICORN_WORKERS", profile["workers"]))
+threads = int(os.getenv("GUNICORN_THREADS", profile["threads"]))
+# open connections per gevent worker
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+preload_app = os.getenv("GUNICORN_PRELOAD", str(profile["preload_app"])).lower() == "true"
+# seconds an idle client connection is kept, behind a load balancer keep it
+# above the balancer's idle timeout
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+# restart workers after some requests (0 never), the jitter spreads the restarts
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# 2 ** WORKER_BITS of service/sharding.py, which is not imported here as that
+# would load the app in the master of the gevent profile
+ID_WORKERS = 32
+id_worker = int(os.getenv("ID_WORKER")) if os.getenv("ID_WORKER") else None
+if id_worker is not None and id_worker + workers > ID_WORKERS:
+    raise RuntimeError(
+        "ID_WORKER {} leaves {} worker numbers for {} workers".format(id_worker, ID_WORKERS - id_worker, workers)
+    )
+
+
+def pre_fork(server, worker):
+    """ Closes the connections the preloaded app opened in the master and picks the id slot of the worker """
+    if "service" in sys.modules:
+        sys.modules["service"].before_fork()
+    if id_worker is not None:
+        used = {other.id_slot for other in server.WORKERS.values()}
+        free = [slot for slot in range(ID_WORKERS - id_worker) if slot not in used]
+        if not free:
+            raise RuntimeError("No worker number is left for another worker above ID_WORKER {}".format(id_worker))
+        worker.id_slot = free[0]
+
+
+def post_fork(server, worker):
+    """ Drops what a worker inherited from the preloaded app and sets its worker number """
+    if worker_class == "gevent":
+        patch_psycopg()
+    worker_number = None
+    if id_worker is not None:
+        worker_number = id_worker + worker.id_slot
+        # read by the config of an app that is not preloaded
+        os.environ["ID_WORKER"] = str(worker_number)
+    if "service" in sys.modules:
+        sys.modules["service"].after_fork(worker_number)
+
+
+def patch_psycopg():
+    """ Makes psycopg2 wait on gevent rather than block the worker """
+    try:
+        from psycogreen.gevent import patch_psycopg as patch
+    except ImportError:
+        return
+    patch()
@@ -17,17 +17,17 @@ app.config.from_object('config')
 
 # Import the rutes After the Flask app is created
 from service import service, models
+from service.logs import init_logging, restart_logging
 
 # Set up logging for production
 if __name__ != '__main__':
     gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.handlers = []
     app.logger.setLevel(gunicorn_logger.level)
     app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    # Make all log formats consistent and write them from a background thread
+    if gunicorn_logger.handlers:
+        init_logging(app, gunicorn_logger.handlers)
     app.logger.info('Logging handler established')
 
 app.logger.info(70 * "*")
@@ -43,3 +43,24 @@ except Exception as error:
     sys.exit(4)
 
 app.logger.info("Service inititalized!")
+
+
+def before_fork():
+    """ Closes the connections of a preloaded app so that no worker inherits them """
+    models.db.dispose_engines(app)
+    if models.Pat.shards is not None:
+        models.Pat.shards.dispose()
+
+
+def after_fork(id_worker=None):
+    """
+    Makes a worker forked from a preloaded app safe to serve requests
+
+    Called by the post_fork hook of gunicorn.conf.py, a child must neither
+    share the database connections of its parent nor rely on its threads,
+    and generates ids with the worker number it is given (ID_WORKER if None)
+    """
+    models.db.dispose_engines(app)
+    if models.Pat.shards is not None:
+        models.Pat.shards.after_fork(id_worker)
+    restart_logging(app)
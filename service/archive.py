@@ -0,0 +1,89 @@
+# License info goes here.
+
+"""
+Archival of Deleted Patients
+
+Pat.delete only marks a row deleted (its deleted_at), so that the records
+of former members are retained, and the finders skip the deleted rows. The
+archiver moves the rows deleted more than some days ago from the pat table
+to the pat_archive table, which keeps the hot table and its indexes down to
+the active members and the recently deleted ones.
+
+Rows are moved a batch at a time, oldest deletion first (read from the
+partial ix_pat_deleted_at index). A batch is copied with INSERT ... SELECT,
+the encrypted columns as they are, and deleted in the same short
+transaction, so a row is always in exactly one of the tables and a stopped
+archiver simply resumes with the rows left. Like the backfills it sleeps
+between batches and waits while the read replicas lag behind. The finders
+read the archive too when asked to include_archived, for audits.
+"""
+import time
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import and_, bindparam, select
+from service.backfill import wait_for_replicas
+from service.models import Pat, ArchivedPat, db
+
+logger = logging.getLogger("service.archive")
+
+
+def archive_batch(session, cutoff, batch_size, now):
+    """ Moves the next batch of Pats deleted before the cutoff to the archive
+
+    Returns the number of Pats archived
+    """
+    table = Pat.__table__
+    ids = [row.id for row in session.execute(
+        select([table.c.id])
+        .where(and_(table.c.deleted_at.isnot(None), table.c.deleted_at < cutoff))
+        .order_by(table.c.deleted_at)
+        .limit(batch_size)
+    )]
+    if not ids:
+        return 0
+    columns = list(table.columns)
+    session.execute(ArchivedPat.__table__.insert().from_select(
+        [column.name for column in columns] + ["archived_at"],
+        select(columns + [bindparam("archived_at", now, type_=db.DateTime)]).where(table.c.id.in_(ids)),
+    ))
+    session.execute(table.delete().where(table.c.id.in_(ids)))
+    return len(ids)
+
+
+def run(older_than_days, batch_size=1000, sleep=0.1, max_lag=5.0, max_batches=None, report=None, now=None):
+    """
+    Archives the Pats deleted more than some days ago
+
+    Args:
+        older_than_days (float): the days since deletion before a Pat is archived
+        batch_size (int): the Pats moved by a transaction
+        sleep (float): the seconds to wait between batches
+        max_lag (float): the replication lag in seconds to wait for
+        max_batches (int): the most batches run now, None to run until done
+        report (function): called with the shard and the Pats archived so far after every batch
+        now (datetime): the current time, utcnow() if None
+
+    Returns the number of Pats archived
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=older_than_days)
+    if Pat.shards is None:
+        targets = [(0, db.session)]
+    else:
+        targets = list(enumerate(Pat.shards.sessions))
+    logger.info("Archiving the Pats deleted before %s", cutoff)
+    total = batches = 0
+    for shard, session in targets:
+        while max_batches is None or batches < max_batches:
+            wait_for_replicas(max_lag, sleep)
+            count = archive_batch(session(), cutoff, batch_size, now)
+            session.commit()
+            batches += 1
+            total += count
+            if report is not None:
+                report(shard, total)
+            if count < batch_size:
+                break
+            time.sleep(sleep)
+    logger.info("Archived %d Pats", total)
+    return total
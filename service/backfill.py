@@ -0,0 +1,179 @@
+# License info goes here.
+
+"""
+Online Backfills
+
+A column is added to Pat without downtime in three steps:
+
+1. Pat.init_db adds the missing nullable column online (see service/schema.py)
+2. every write fills the new column as well (the dual write of
+   Pat.update_derived_columns, called by deserialize, create and save)
+3. a backfill job fills the column of the rows written before
+
+The job walks the table in id order, a batch of rows at a time, and only
+updates the rows whose column is still NULL, so it never overwrites a value
+written by the application meanwhile. Each batch is a short transaction,
+the job sleeps between batches and waits while the read replicas lag behind,
+so the table is never locked for long and replication keeps up. The last id
+reached is stored in the backfill_job table after every batch: a job can be
+paused from another process and resumes where it stopped.
+"""
+import time
+import logging
+from datetime import datetime
+from sqlalchemy import and_, bindparam, select
+from service import matching
+from service.models import Pat, BackfillJob, db
+
+logger = logging.getLogger("service.backfill")
+
+
+class BackfillError(Exception):
+    """ Used for a backfill that does not exist """
+    pass
+
+
+class Backfill:
+    """ Fills a derived Pat column from the columns it is computed from """
+
+    def __init__(self, column, sources, compute):
+        self.column = column
+        self.sources = sources
+        self.compute = compute
+
+    def run_batch(self, session, last_id, batch_size):
+        """ Fills the next batch of rows after last_id
+
+        Returns the number of rows read and the last id of the batch
+        """
+        table = Pat.__table__
+        column = table.c[self.column]
+        rows = session.execute(
+            select([table.c.id] + [table.c[name] for name in self.sources])
+            .where(and_(table.c.id > last_id, column.is_(None)))
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            return 0, last_id
+        session.execute(
+            table.update()
+            .where(and_(table.c.id == bindparam("row_id"), column.is_(None)))
+            .values({self.column: bindparam("value")}),
+            [{"row_id": row.id, "value": self.compute(row)} for row in rows],
+        )
+        return len(rows), rows[-1].id
+
+
+# The backfills by name, they compute what Pat.update_derived_columns and
+# Pat.update_document write
+BACKFILLS = {
+    "block_key": Backfill(
+        "block_key", ("lname", "DOB", "postal_code"),
+        lambda row: matching.block_key(row.lname, row.DOB, row.postal_code),
+    ),
+    "phone_normalized": Backfill(
+        "phone_normalized", ("phone_home",),
+        lambda row: matching.digits(row.phone_home) or None,
+    ),
+    # serialize only reads attributes, so it serializes a row as well as a Pat
+    "doc": Backfill(
+        "doc", ("title", "fname", "mname", "lname", "street", "postal_code", "city", "state",
+                "phone_home", "email", "DOB", "gender", "deleted_at"),
+        lambda row: Pat.encode_document(Pat.serialize(row)),
+    ),
+}
+
+
+def run(name, batch_size=1000, sleep=0.1, max_lag=5.0, max_batches=None, report=None):
+    """
+    Runs a backfill, or resumes it after the last batch done
+
+    Args:
+        name (string): the name of the backfill in BACKFILLS
+        batch_size (int): the rows updated by a transaction
+        sleep (float): the seconds to wait between batches
+        max_lag (float): the replication lag in seconds to wait for
+        max_batches (int): the most batches run now, None to run until done
+        report (function): called with the BackfillJob after every batch
+
+    Returns True when the backfill is done, False when it was paused or stopped
+    """
+    backfill = get(name)
+    if Pat.shards is None:
+        targets = [(0, db.session)]
+    else:
+        targets = list(enumerate(Pat.shards.sessions))
+    batches = 0
+    for shard, session in targets:
+        job = BackfillJob.query.get((name, shard))
+        if job is None:
+            job = BackfillJob(name=name, shard=shard)
+            db.session.add(job)
+        elif job.status == "done":
+            continue
+        job.status = "running"
+        db.session.commit()
+        logger.info("Backfilling %s on shard %s after id %s", name, shard, job.last_id)
+
+        while True:
+            if max_batches is not None and batches >= max_batches:
+                return False
+            # another process may have paused the job
+            db.session.refresh(job)
+            if job.status == "paused":
+                logger.info("Backfill %s paused at id %s", name, job.last_id)
+                return False
+            wait_for_replicas(max_lag, sleep)
+            count, job.last_id = backfill.run_batch(session(), job.last_id, batch_size)
+            if session is not db.session:
+                session.commit()
+            job.rows += count
+            job.updated_at = datetime.utcnow()
+            if count < batch_size:
+                job.status = "done"
+            db.session.commit()
+            batches += 1
+            if report is not None:
+                report(job)
+            if job.status == "done":
+                break
+            time.sleep(sleep)
+    logger.info("Backfill %s done", name)
+    return True
+
+
+def pause(name):
+    """ Asks the running jobs of a backfill to stop after their current batch """
+    get(name)
+    count = BackfillJob.query.filter(
+        BackfillJob.name == name, BackfillJob.status == "running"
+    ).update({"status": "paused"}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def jobs(name=None):
+    """ Returns the backfill jobs, of one backfill or of all of them """
+    query = BackfillJob.query
+    if name is not None:
+        query = query.filter(BackfillJob.name == name)
+    return query.order_by(BackfillJob.name, BackfillJob.shard).all()
+
+
+def get(name):
+    """ Returns the backfill with a name """
+    try:
+        return BACKFILLS[name]
+    except KeyError:
+        raise BackfillError("Unknown backfill: {}".format(name))
+
+
+def wait_for_replicas(max_lag, sleep):
+    """ Waits until the read replicas are less than max_lag seconds behind """
+    while True:
+        lag = db.router.max_lag(db)
+        if lag <= max_lag:
+            return
+        logger.warning("Replicas are %.1f seconds behind, waiting", lag)
+        time.sleep(max(sleep, 1.0))
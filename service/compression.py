@@ -0,0 +1,148 @@
+# License info goes here.
+
+"""
+Response Compression
+
+Negotiates a Content-Encoding from the request's Accept-Encoding header and
+compresses the response body with it. Whole bodies are compressed once they
+reach COMPRESSION_MIN_SIZE, streamed bodies are compressed chunk by chunk as
+they are sent.
+
+Encodings
+---------
+gzip - always available (zlib)
+br - available when the brotli package is installed
+zstd - available when the zstandard package is installed
+"""
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Mimetypes worth compressing besides text/* and */*+json
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+}
+
+
+class GzipCompressor:
+    """ Incremental gzip compressor """
+
+    encoding = "gzip"
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    """ Incremental brotli compressor """
+
+    encoding = "br"
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    """ Incremental zstandard compressor """
+
+    encoding = "zstd"
+
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+def available_compressors():
+    """ Returns the compressors that can be used, in order of preference """
+    compressors = []
+    if zstandard is not None:
+        compressors.append((ZstdCompressor, "COMPRESSION_ZSTD_LEVEL"))
+    if brotli is not None:
+        compressors.append((BrotliCompressor, "COMPRESSION_BROTLI_LEVEL"))
+    compressors.append((GzipCompressor, "COMPRESSION_GZIP_LEVEL"))
+    return compressors
+
+
+def negotiate_compressor():
+    """ Returns a new compressor for the best encoding the client accepts, or None """
+    compressors = available_compressors()
+    encoding = request.accept_encodings.best_match([c.encoding for c, _ in compressors])
+    for compressor, level_key in compressors:
+        if compressor.encoding == encoding:
+            return compressor(current_app.config[level_key])
+    return None
+
+
+def is_compressible(response):
+    """ Checks that a response can be compressed """
+    if not 200 <= response.status_code < 300 or response.status_code == 204:
+        return False
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return False
+    mimetype = response.mimetype or ""
+    return mimetype.startswith("text/") or mimetype.endswith("+json") \
+        or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def compress_response(response):
+    """ Compresses a response with the negotiated encoding """
+    if not current_app.config["COMPRESSION_ENABLED"] or not is_compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    if not response.is_streamed and \
+            response.calculate_content_length() < current_app.config["COMPRESSION_MIN_SIZE"]:
+        return response
+    compressor = negotiate_compressor()
+    if compressor is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+    response.headers["Content-Encoding"] = compressor.encoding
+    return response
+
+
+def compress_stream(chunks, compressor):
+    """ Compresses an iterable of chunks incrementally """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
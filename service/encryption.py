@@ -0,0 +1,181 @@
+# License info goes here.
+
+"""
+Field Level Encryption
+
+EncryptedString is a column type that encrypts values on their way to the
+database and decrypts them as rows are loaded, so the models and finders
+keep working on plaintext. Columns are encrypted either
+
+deterministic - AES-SIV, the same value always gives the same ciphertext so
+    equality filters (find_by_lname, find_by_phone, ...) and their indexes
+    keep working, at the cost of revealing which rows hold equal values. The
+    finders look a value up in every form it can be stored in (see
+    EncryptedString.search_values) so that rows under an older key or still
+    in plaintext are found too
+randomized - AES-GCM with a random nonce, for the columns never searched
+
+The keys are listed in FIELD_ENCRYPTION_KEYS as "id:base64 key" pairs, the
+first one encrypts and all of them decrypt, so that keys can be rotated.
+The ciphers derived from a key are created once and cached, and decrypted
+deterministic values are kept in an LRU cache since lists repeat the same
+names. Values that are not encrypted are returned as they are, which lets a
+table be encrypted row by row; without keys nothing is encrypted.
+
+Encryption needs the cryptography package.
+"""
+import os
+import base64
+from sqlalchemy.types import TypeDecorator, String
+from sqlalchemy.util import LRUCache
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, AESSIV
+except ImportError:
+    AESGCM = AESSIV = None
+
+# Marks an encrypted value, followed by the key id and the base64 ciphertext
+PREFIX = "enc1:"
+MAX_KEY_ID_LENGTH = 16
+# Bytes added to a value: the AES-SIV tag, or the AES-GCM nonce and tag
+OVERHEAD = 28
+
+
+class EncryptionError(Exception):
+    """ Used for missing or invalid encryption keys and values """
+    pass
+
+
+class KeyRing:
+    """ The encryption keys and the ciphers derived from them """
+
+    def __init__(self):
+        self.keys = {}
+        self.current = None
+        self._ciphers = {}
+        self._decrypted = LRUCache(10000)
+
+    @property
+    def enabled(self):
+        return self.current is not None
+
+    def configure(self, keys, cache_size=10000):
+        """ Sets the keys, a list of (key id, base64 key) with the current key first """
+        if keys and AESSIV is None:
+            raise EncryptionError("Field encryption needs the cryptography package")
+        self.keys = {}
+        for key_id, key in keys:
+            if not key_id or len(key_id) > MAX_KEY_ID_LENGTH or ":" in key_id:
+                raise EncryptionError("Invalid key id: {}".format(key_id))
+            key = base64.b64decode(key)
+            if len(key) < 32:
+                raise EncryptionError("Key {} must have at least 32 bytes".format(key_id))
+            self.keys[key_id] = key
+        self.current = keys[0][0] if keys else None
+        self._ciphers = {}
+        self._decrypted = LRUCache(cache_size)
+
+    def cipher(self, key_id, deterministic):
+        """ Returns the cached cipher of a key """
+        cipher = self._ciphers.get((key_id, deterministic))
+        if cipher is None:
+            if key_id not in self.keys:
+                raise EncryptionError("Unknown key id: {}".format(key_id))
+            if deterministic:
+                cipher = AESSIV(self._derive(key_id, b"pat deterministic", 64))
+            else:
+                cipher = AESGCM(self._derive(key_id, b"pat randomized", 32))
+            self._ciphers[key_id, deterministic] = cipher
+        return cipher
+
+    def _derive(self, key_id, purpose, length):
+        """ Derives a key for a purpose so that the ciphers never share one """
+        return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=purpose).derive(self.keys[key_id])
+
+    def encrypt(self, value, deterministic, context, key_id=None):
+        """ Encrypts a string, bound to its context (the column), with the current key by default """
+        key_id = key_id or self.current
+        data = value.encode("utf-8")
+        cipher = self.cipher(key_id, deterministic)
+        if deterministic:
+            payload = cipher.encrypt(data, [context])
+        else:
+            nonce = os.urandom(12)
+            payload = nonce + cipher.encrypt(nonce, data, context)
+        return "{}{}:{}".format(PREFIX, key_id, base64.b64encode(payload).decode("ascii"))
+
+    def decrypt(self, value, deterministic, context):
+        """ Decrypts a value, returning the values that are not encrypted as they are """
+        if not value.startswith(PREFIX):
+            return value
+        if deterministic:
+            plaintext = self._decrypted.get((context, value))
+            if plaintext is not None:
+                return plaintext
+        key_id, _, payload = value[len(PREFIX):].partition(":")
+        payload = base64.b64decode(payload)
+        cipher = self.cipher(key_id, deterministic)
+        try:
+            if deterministic:
+                data = cipher.decrypt(payload, [context])
+            else:
+                data = cipher.decrypt(payload[:12], payload[12:], context)
+        except Exception:
+            raise EncryptionError("Cannot decrypt a value of {}".format(context.decode("utf-8")))
+        plaintext = data.decode("utf-8")
+        if deterministic:
+            self._decrypted[context, value] = plaintext
+        return plaintext
+
+
+# The key ring used by the encrypted columns, set up by Pat.init_db
+keyring = KeyRing()
+
+
+def ciphertext_length(length):
+    """ Returns the length of the encrypted form of a string of some length """
+    data = 4 * length + OVERHEAD  # UTF-8 takes up to 4 bytes per character
+    return len(PREFIX) + MAX_KEY_ID_LENGTH + 1 + 4 * ((data + 2) // 3)
+
+
+class EncryptedString(TypeDecorator):
+    """
+    A string column stored encrypted
+
+    Args:
+        length (int): the longest plaintext, None for no limit
+        deterministic (boolean): True for the columns searched by equality
+        context (string): the name of the column, a ciphertext only decrypts
+            in the column it was written to
+    """
+
+    impl = String
+
+    def __init__(self, length, deterministic=False, context=""):
+        super().__init__(None if length is None else ciphertext_length(length))
+        self.plaintext_length = length
+        self.deterministic = deterministic
+        self.context = context.encode("utf-8")
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not keyring.enabled:
+            return value
+        return keyring.encrypt(value, self.deterministic, self.context)
+
+    def search_values(self, value):
+        """ Returns every form a value of a deterministic column can be stored in
+
+        That is the value as it is, for the rows written before encryption was
+        turned on, and its ciphertext under each of the keys, for the rows
+        written before a key rotation
+        """
+        if value is None:
+            return [value]
+        return [value] + [keyring.encrypt(value, True, self.context, key_id) for key_id in keyring.keys]
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+        return keyring.decrypt(value, self.deterministic, self.context)
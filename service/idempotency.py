@@ -0,0 +1,184 @@
+# License info goes here.
+
+"""
+Idempotency Keys
+
+Clients can send an Idempotency-Key header with a request that must not run
+twice, such as POST /pats. The first request with a key records it as in
+progress, runs, and stores its response with the key for
+IDEMPOTENCY_TTL_SECONDS. Retries with the same key and body get the stored
+response back without running again, while a retry arriving while the first
+request still runs, or one reusing the key for another body, gets a 409.
+
+Keys belong to the client that sent them (its API key, or its address), so
+a client never gets the response stored for another one. A key whose request
+is still marked in progress after IDEMPOTENCY_LOCK_SECONDS, e.g. because its
+worker was killed, is taken over by the next retry.
+
+The keys are kept in the idempotency_key table so that every worker sees
+them, with the finished responses also cached in memory. Requests with the
+same key in one worker wait on a lock instead of racing to the database.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import abort
+from sqlalchemy.exc import IntegrityError
+from service.models import IdempotencyKey, DataValidationError, db
+
+# Locks are striped by key so that they cost nothing to create
+LOCK_STRIPES = 64
+
+
+class StoredResponse:
+    """ The response recorded for an idempotency key """
+
+    def __init__(self, fingerprint, status_code, body, location, expires_at):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.body = body
+        self.location = location
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row.fingerprint, row.status_code, row.body, row.location, row.expires_at)
+
+
+class IdempotencyStore:
+    """ Records the requests made with an Idempotency-Key and their responses """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self._cache.clear()
+
+    @staticmethod
+    def scoped(client, key):
+        """ Returns the stored key of a client's Idempotency-Key
+
+        The client key is hashed, as it may hold the client's API key
+        """
+        return hashlib.sha256(client.encode()).hexdigest()[:32] + ":" + key
+
+    @staticmethod
+    def fingerprint(method, path, body):
+        """ Returns a digest of a request, to spot keys reused for other requests """
+        return hashlib.sha256(method.encode() + b" " + path.encode() + b"\n" + body).hexdigest()
+
+    def lock(self, key):
+        """ Returns the lock that serializes the requests made with a key """
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def begin(self, key, fingerprint):
+        """
+        Starts a request made with an idempotency key
+
+        Args:
+            key (string): the key scoped to the client, see scoped()
+            fingerprint (string): the digest of the request
+
+        Returns the StoredResponse to replay when the key already has one,
+        or None after recording the key as in progress
+        """
+        if len(key) > IdempotencyKey.key.type.length:
+            raise DataValidationError("Invalid Idempotency-Key: too long")
+        now = datetime.utcnow()
+        stored = self._cached(key, now)
+        row = None
+        if stored is None:
+            row = IdempotencyKey.query.get(key)
+            if row is not None and row.expires_at <= now:
+                db.session.delete(row)
+                db.session.commit()
+                row = None
+            if row is not None:
+                stored = StoredResponse.from_row(row)
+                if stored.status_code is not None:
+                    self._remember(key, stored)
+
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                abort(409, "The Idempotency-Key was used for a different request.")
+            if stored.status_code is None:
+                if not self._take_over(row, now):
+                    abort(409, "A request with the same Idempotency-Key is still in progress.")
+                return None
+            return stored
+
+        ttl = timedelta(seconds=self.app.config["IDEMPOTENCY_TTL_SECONDS"])
+        db.session.add(IdempotencyKey(key=key, fingerprint=fingerprint, started_at=now, expires_at=now + ttl))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another worker recorded the key first
+            db.session.rollback()
+            abort(409, "A request with the same Idempotency-Key is still in progress.")
+        return None
+
+    def _take_over(self, row, now):
+        """ Restarts a request left in progress for longer than IDEMPOTENCY_LOCK_SECONDS
+
+        Returns False while the request may still run, or when another retry took it over first
+        """
+        stale = now - timedelta(seconds=self.app.config["IDEMPOTENCY_LOCK_SECONDS"])
+        if row.started_at is not None and row.started_at > stale:
+            return False
+        # only one retry wins the conditional update
+        taken = IdempotencyKey.query.filter(
+            IdempotencyKey.key == row.key,
+            IdempotencyKey.status_code.is_(None),
+            IdempotencyKey.started_at.is_(None) if row.started_at is None else IdempotencyKey.started_at == row.started_at,
+        ).update({IdempotencyKey.started_at: now}, synchronize_session=False)
+        db.session.commit()
+        return taken == 1
+
+    def complete(self, key, response):
+        """ Stores the response of a request made with an idempotency key """
+        row = IdempotencyKey.query.get(key)
+        row.status_code = response.status_code
+        row.body = response.get_data()
+        row.location = response.headers.get("Location")
+        db.session.commit()
+        self._remember(key, StoredResponse.from_row(row))
+
+    def abandon(self, key):
+        """ Forgets a key whose request failed so that it can be retried """
+        db.session.rollback()
+        IdempotencyKey.query.filter(
+            IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    def purge_expired(self):
+        """ Deletes the expired keys and returns how many there were """
+        count = IdempotencyKey.query.filter(
+            IdempotencyKey.expires_at <= datetime.utcnow()
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def _cached(self, key, now):
+        """ Returns the cached response of a key unless it expired """
+        with self._cache_lock:
+            stored = self._cache.get(key)
+            if stored is not None and stored.expires_at <= now:
+                del self._cache[key]
+                stored = None
+            return stored
+
+    def _remember(self, key, stored):
+        """ Caches the finished response of a key """
+        with self._cache_lock:
+            self._cache.pop(key, None)
+            self._cache[key] = stored
+            while len(self._cache) > self.app.config["IDEMPOTENCY_CACHE_SIZE"]:
+                self._cache.popitem(last=False)
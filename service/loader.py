@@ -0,0 +1,253 @@
+# License info goes here.
+
+"""
+Bulk Loader
+
+Loads patients from CSV files with the same columns as the JSON records of
+the API (fname, lname, postal_code, DOB, sex, ...). The files are read in
+chunks of rows that a pool of processes validates with Pat.deserialize and
+writes on connections of their own, with PostgreSQL COPY or batched INSERTs.
+
+Every chunk is written in one transaction together with its LoadCheckpoint
+row, so after a crash the same command skips the chunks that made it and
+loads the rest, without duplicating or losing patients. Rejected rows are
+reported with their file, line and error.
+"""
+import io
+import os
+import csv
+import time
+import logging
+from enum import Enum
+from itertools import islice
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import IntegrityError
+from service.models import Pat, LoadCheckpoint, DataValidationError
+
+logger = logging.getLogger("service.loader")
+
+# Columns whose empty cells are missing values rather than empty strings
+OPTIONAL_FIELDS = ("title", "mname", "email")
+
+# The columns written by the loader, the ids are generated by the database
+COLUMNS = [column for column in Pat.__table__.columns if column.name != "id"]
+
+_engine = None  # the engine of a worker process
+
+
+class LoadError(Exception):
+    """ Used when a load cannot be started or resumed """
+    pass
+
+
+class ChunkResult:
+    """ The outcome of loading a chunk of an input file """
+
+    def __init__(self, source, chunk, loaded=0, rejects=None, skipped=False):
+        self.source = source
+        self.chunk = chunk
+        self.loaded = loaded
+        self.rejects = rejects or []  # (line, error) of the rejected rows
+        self.skipped = skipped
+
+
+class LoadStats:
+    """ Running totals of a load """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.chunks = 0
+        self.skipped = 0
+        self.loaded = 0
+        self.rejected = 0
+
+    def add(self, result):
+        if result.skipped:
+            self.skipped += 1
+            return
+        self.chunks += 1
+        self.loaded += result.loaded
+        self.rejected += len(result.rejects)
+
+    @property
+    def rate(self):
+        """ Returns the patients loaded per second """
+        return self.loaded / max(time.monotonic() - self.started, 1e-9)
+
+    def __str__(self):
+        return "{} chunks ({} skipped), {} loaded, {} rejected, {:.0f} rows/s".format(
+            self.chunks, self.skipped, self.loaded, self.rejected, self.rate
+        )
+
+
+def read_chunks(path, chunk_size):
+    """ Yields the (chunk number, rows) of a CSV file, a row being a (line, dict) tuple """
+    with open(path, newline="") as csvfile:
+        reader = csv.DictReader(csvfile)
+        chunk = 0
+        while True:
+            rows = [(reader.line_num, row) for row in islice(reader, chunk_size)]
+            if not rows:
+                return
+            yield chunk, rows
+            chunk += 1
+
+
+def validate(rows):
+    """ Deserializes rows into the column values of Pats
+
+    Returns the list of column values and the (line, error) of the rejected rows
+    """
+    records, rejects = [], []
+    for line, row in rows:
+        data = {name: (value or None) if name in OPTIONAL_FIELDS else value for name, value in row.items()}
+        try:
+            pat = Pat().deserialize(data)
+        except DataValidationError as error:
+            rejects.append((line, str(error)))
+            continue
+        records.append({column.name: getattr(pat, column.key) for column in COLUMNS})
+    return records, rejects
+
+
+def insert(connection, records, use_copy=True):
+    """ Writes column values to the Pat table, with COPY on PostgreSQL """
+    if not records:
+        return
+    if use_copy and connection.dialect.name == "postgresql":
+        copy(connection, records)
+    else:
+        connection.execute(Pat.__table__.insert(), records)
+
+
+def copy(connection, records):
+    """ Writes column values to the Pat table with a PostgreSQL COPY """
+    quote = connection.dialect.identifier_preparer.quote
+    # COPY skips the column types, so encrypt and convert the values here
+    processors = [column.type.bind_processor(connection.dialect) or _unchanged for column in COLUMNS]
+    buffer = io.StringIO()
+    for record in records:
+        values = [process(record[column.name]) for column, process in zip(COLUMNS, processors)]
+        buffer.write("\t".join(_copy_text(value) for value in values))
+        buffer.write("\n")
+    buffer.seek(0)
+    statement = "COPY {} ({}) FROM STDIN".format(
+        quote(Pat.__table__.name), ", ".join(quote(column.name) for column in COLUMNS)
+    )
+    connection.connection.cursor().copy_expert(statement, buffer)
+
+
+def _unchanged(value):
+    return value
+
+
+def _copy_text(value):
+    """ Formats a value for the text format of COPY """
+    if value is None:
+        return "\\N"
+    if isinstance(value, Enum):
+        value = value.name
+    elif isinstance(value, datetime):
+        value = value.isoformat(" ")
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def engine_options(uri):
+    """ Returns the engine options of a loader connection """
+    if uri.startswith(("postgres://", "postgresql://", "postgresql+psycopg2://")):
+        # send the INSERT batches as multi-row VALUES instead of one per row
+        return {"executemany_mode": "values"}
+    return {}
+
+
+def _init_worker(uri):
+    """ Opens the connection pool of a worker process """
+    global _engine
+    _engine = create_engine(uri, **engine_options(uri))
+
+
+def load_chunk(source, chunk, chunk_size, rows, use_copy=True):
+    """ Validates and writes a chunk with its checkpoint, in a worker process """
+    records, rejects = validate(rows)
+    with _engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            # the checkpoint goes first so that a concurrent load of the chunk fails fast
+            connection.execute(
+                LoadCheckpoint.__table__.insert(),
+                source=source, chunk=chunk, chunk_size=chunk_size,
+                loaded=len(records), rejected=len(rejects), finished_at=datetime.utcnow(),
+            )
+        except IntegrityError:
+            # another load wrote the chunk first
+            transaction.rollback()
+            return ChunkResult(source, chunk, skipped=True)
+        try:
+            insert(connection, records, use_copy)
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            raise
+    return ChunkResult(source, chunk, len(records), rejects)
+
+
+def load(uri, paths, workers=None, chunk_size=10000, use_copy=True, rejects=None, report=None):
+    """
+    Loads patients from CSV files, resuming after the chunks already loaded
+
+    Args:
+        uri (string): the database to load into, shared by the worker processes
+        paths (list): the CSV files to load
+        workers (int): the number of worker processes, the CPU count if None
+        chunk_size (int): the rows of a chunk, it must not change between resumes
+        use_copy (boolean): False to use batched INSERTs on PostgreSQL too
+        rejects (file): a text file the rejected rows are written to as CSV
+        report (function): called with the LoadStats after every chunk
+
+    Returns the LoadStats of the load
+    """
+    workers = workers or os.cpu_count()
+    engine = create_engine(uri)
+    Pat.__table__.create(engine, checkfirst=True)
+    LoadCheckpoint.__table__.create(engine, checkfirst=True)
+    checkpoints = LoadCheckpoint.__table__
+    done = {
+        (row.source, row.chunk): row.chunk_size
+        for row in engine.execute(select([checkpoints.c.source, checkpoints.c.chunk, checkpoints.c.chunk_size]))
+    }
+    engine.dispose()
+    rejects_writer = csv.writer(rejects) if rejects is not None else None
+    stats = LoadStats()
+
+    def collect(futures):
+        for future in futures:
+            result = future.result()
+            stats.add(result)
+            if rejects_writer is not None:
+                for line, error in result.rejects:
+                    rejects_writer.writerow([result.source, line, error])
+            if report is not None:
+                report(stats)
+
+    logger.info("Loading %d files with %d workers", len(paths), workers)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(uri,)) as executor:
+        pending = set()
+        for path in paths:
+            source = os.path.abspath(path)
+            for chunk, rows in read_chunks(path, chunk_size):
+                if (source, chunk) in done:
+                    if done[source, chunk] != chunk_size:
+                        raise LoadError("{} was loaded in chunks of {} rows, resume with that chunk size".format(
+                            path, done[source, chunk]))
+                    stats.add(ChunkResult(source, chunk, skipped=True))
+                    continue
+                # keep a few chunks per worker in flight, not the whole file
+                if len(pending) >= 2 * workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                pending.add(executor.submit(load_chunk, source, chunk, chunk_size, rows, use_copy))
+        collect(pending)
+    logger.info("Loaded %s", stats)
+    return stats
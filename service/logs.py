@@ -0,0 +1,159 @@
+# License info goes here.
+
+"""
+Logging Pipeline
+
+Log records are put on a queue by the request thread and formatted and
+written by a background listener thread, so requests never wait on log I/O.
+Records are written as one JSON object per line (LOG_FORMAT=json) or in the
+classic text layout, carry the id of the request that logged them, and the
+INFO lines of busy loggers can be sampled with LOG_SAMPLE_RATES. The modules
+log to children of the app's logger ("service.models", ...), so that their
+records go through the same queue.
+"""
+import json
+import queue
+import atexit
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from flask import request, has_request_context
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] [%(request_id)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+# Argument types that are safe to format later on the listener thread
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as a single line JSON object """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class TextFormatter(logging.Formatter):
+    """ Formats a record in the text layout, with a request id of "-" when it has none
+
+    The handlers are shared with gunicorn, whose own records never pass
+    through the RequestIdFilter of the app
+    """
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT, DATE_FORMAT)
+
+    def format(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = "-"
+        return super().format(record)
+
+
+class RequestIdFilter(logging.Filter):
+    """ Tags a record with the id of the request that logged it """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = getattr(request, "request_id", "-")
+        else:
+            record.request_id = "-"
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps a fraction of the INFO and DEBUG records of the listed loggers """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """ Queues records as they are, leaving the formatting to the listener """
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Formatting is deferred, unless an argument could change before
+        # the listener gets to it
+        if record.args and not all(isinstance(arg, PLAIN_TYPES) for arg in _args(record)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # never block a request on logging, drop the record instead
+            self.dropped += 1
+
+
+def _args(record):
+    """ Returns the formatting arguments of a record as a sequence """
+    return record.args.values() if isinstance(record.args, dict) else record.args
+
+
+def stop_listener(listener):
+    """ Writes the queued records and stops the listener if it still runs """
+    if listener._thread is not None:
+        listener.stop()
+
+
+def init_logging(app, handlers):
+    """
+    Routes the app's log records through a queue to the given handlers
+
+    Args:
+        app (Flask): the app whose logger is set up
+        handlers (list): the handlers that finally write the records
+    """
+    if app.config["LOG_FORMAT"] == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = BackgroundQueueHandler(queue.Queue(app.config["LOG_QUEUE_SIZE"]))
+    queue_handler.addFilter(RequestIdFilter())
+    if app.config["LOG_SAMPLE_RATES"]:
+        queue_handler.addFilter(SamplingFilter(app.config["LOG_SAMPLE_RATES"]))
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_listener, listener)
+
+    app.logger.handlers = [queue_handler]
+    app.extensions["log_listener"] = listener
+    return listener
+
+
+def restart_logging(app):
+    """
+    Starts a log listener of its own in a forked worker
+
+    The listener thread of the parent does not survive a fork, and its queue
+    may have been locked at that moment, so a new queue and listener are set
+    up with the same handlers. Returns the listener, None without logging set up
+    """
+    listener = app.extensions.get("log_listener")
+    if listener is None:
+        return None
+    listener._thread = None  # it only ran in the parent
+    return init_logging(app, listener.handlers)
@@ -0,0 +1,105 @@
+# License info goes here.
+
+"""
+Duplicate Patient Matching
+
+Comparing every patient with every other one is quadratic, so patients are
+first grouped into blocks that share a blocking key: the normalized last
+name, the date of birth and the first three digits of the zip code. Only the
+patients of a block are compared and scored on their first name, phone,
+email and street, which keeps a run over the whole table roughly linear as
+long as the blocks stay small.
+"""
+import logging
+import unicodedata
+from difflib import SequenceMatcher
+from itertools import combinations
+
+logger = logging.getLogger("service.matching")
+
+# Weights of the compared fields in the similarity score
+WEIGHTS = {
+    "fname": 0.4,
+    "phone_home": 0.25,
+    "email": 0.2,
+    "street": 0.15,
+}
+
+
+def normalize_name(name):
+    """ Returns a name in lower case ASCII letters only, e.g. "O'Brién" -> "obrien" """
+    if not name:
+        return ""
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return "".join(char for char in name.lower() if char.isalpha())
+
+
+def digits(value):
+    """ Returns the digits of a phone number """
+    return "".join(char for char in value or "" if char.isdigit())
+
+
+def block_key(lname, dob, postal_code):
+    """ Returns the blocking key of a patient, None when a part is missing """
+    name = normalize_name(lname)
+    if not name or dob is None or not postal_code:
+        return None
+    return "{}|{}|{}".format(name, dob.strftime("%Y-%m-%d"), postal_code[:3])
+
+
+def similarity(pat, other):
+    """
+    Scores how likely two patients of the same block are the same person
+
+    Returns a score between 0 and 1. Fields that either patient lacks are
+    left out of the score instead of counting as a mismatch
+    """
+    scores = {
+        "fname": _ratio(normalize_name(pat.fname), normalize_name(other.fname)),
+        "phone_home": _equal(digits(pat.phone_home), digits(other.phone_home)),
+        "email": _equal((pat.email or "").lower(), (other.email or "").lower()),
+        "street": _ratio(_normalize_street(pat.street), _normalize_street(other.street)),
+    }
+    weights = {name: WEIGHTS[name] for name, score in scores.items() if score is not None}
+    if not weights:
+        return 0.0
+    total = sum(weights[name] * scores[name] for name in weights)
+    return round(total / sum(weights.values()), 3)
+
+
+def candidate_pairs(blocks, min_score=0.5, max_block_size=100):
+    """
+    Yields the pairs of patients that are likely duplicates
+
+    Args:
+        blocks (iterable): (block key, list of Pats) tuples
+        min_score (float): the lowest similarity of a pair that is yielded
+        max_block_size (int): blocks with more patients are skipped, comparing
+            them would be quadratic and their key is too common to match on
+
+    Yields (pat, other, score) tuples
+    """
+    for key, pats in blocks:
+        if len(pats) > max_block_size:
+            logger.warning("Skipping block %s with %d patients", key, len(pats))
+            continue
+        for pat, other in combinations(pats, 2):
+            score = similarity(pat, other)
+            if score >= min_score:
+                yield pat, other, score
+
+
+def _normalize_street(street):
+    return " ".join((street or "").lower().replace(".", "").split())
+
+
+def _ratio(value, other):
+    if not value or not other:
+        return None
+    return SequenceMatcher(None, value, other).ratio()
+
+
+def _equal(value, other):
+    if not value or not other:
+        return None
+    return 1.0 if value == other else 0.0
@@ -8,6 +8,10 @@ All of the models are stored in this module
 Models
 ------
 Pat - A patient in membership list
+IdempotencyKey - The stored response of a request sent with an Idempotency-Key
+LoadCheckpoint - A chunk of an input file written by the bulk loader
+BackfillJob - The progress of an online backfill of a Pat column
+ArchivedPat - A deleted Pat moved to the archive table, kept for audits
 
 Attributes:
 -----------
@@ -20,29 +24,89 @@ Primary address - to do: seperate as a foreign table
     state (string) 
 phone_home (string) - the home phone number of a patient, use re to validate
 email (string) - the email of a patient, use package to validate
-DOB (DateTime) - the date of birth of a patient, use datetime() to validate
+DOB (DateTime) - the date of birth of a patient, use datetime() to validate, indexed with the id for range queries
 gender (enum) - Male, Female or Unknown
 * category (string) - the category the patient belongs to (i.e., in, out)
 * eligibility (boolean) - True or False
+block_key (string) - the normalized last name, DOB and zip prefix that duplicates share
+phone_normalized (string) - the digits of the home phone number
+deleted_at (DateTime) - when a patient was deleted, the finders skip deleted
+    patients unless asked to include_archived (see service/archive.py)
+doc (string) - the serialized JSON of a patient when JSON_DOCUMENTS_ENABLED,
+    rewritten on every write so that lists are sent without loading the rows
+
+The names, street, phone, email and the columns derived from them are
+encrypted at rest when FIELD_ENCRYPTION_KEYS are set (see service/encryption.py).
+The searched ones are encrypted deterministically so that their finders still
+use indexes. DOB, the zip code and the state stay in plaintext for the range,
+zip and state queries and for the sharding.
 
 """
+import json
+import heapq
 import logging
+import itertools
 from enum import Enum
-from flask_sqlalchemy import SQLAlchemy
+from flask import abort
+from sqlalchemy import String, bindparam, tuple_, type_coerce
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import deferred, load_only, object_session
+from sqlalchemy.util import LRUCache
+from service.replicas import RoutingSQLAlchemy
+from service.sharding import ShardSet
+from service.schema import add_missing_columns, add_missing_indexes, widen_columns, schema_lock
+from service.encryption import PREFIX, EncryptedString, keyring
+from service import matching
 import re
 #pip install email_validator
 from email_validator import validate_email, EmailNotValidError
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
-logger = logging.getLogger("flask.app")
+logger = logging.getLogger("service.models")
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_db(),
+# it routes the reads of GET requests to the read replicas
+db = RoutingSQLAlchemy()
 
 # Zip code mapping with regular expression
 zipCode = re.compile(r"^[0-9]{5}(?:-[0-9]{4})?$")
 phoneNumb = re.compile(r"^\([0-9]{3}\)\s*[0-9]{3}-[0-9]{4}$")
 
+# Serialized field names mapped to the columns that hold them
+FIELD_COLUMNS = {
+    "id": "id",
+    "title": "title",
+    "fname": "fname",
+    "mname": "mname",
+    "lname": "lname",
+    "street": "street",
+    "postal_code": "postal_code",
+    "city": "city",
+    "state": "state",
+    "phone_home": "phone_home",
+    "email": "email",
+    "DOB": "DOB",
+    "sex": "gender",
+}
+
+
+class StatementCache:
+    """ Bounded cache of the compiled statements of the Pat finders """
+
+    def __init__(self, size=200):
+        self.size = size
+        # without a threshold the least recently used entries are pruned as soon
+        # as the cache holds more than size, rather than half as many again
+        self._cache = LRUCache(size, threshold=0)
+
+    def __call__(self, initial_fn, *args):
+        """ Starts a baked query whose compiled form is kept in the cache """
+        return baked.BakedQuery(self._cache, initial_fn, args)
+
+    def stats(self):
+        """ Returns the number of cached entries and the size of the cache """
+        return {"entries": len(self._cache), "size": self.size}
+
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
@@ -64,24 +128,50 @@ class Pat(db.Model):
     """
 
     app = None
+    shards = None  # the ShardSet holding the table when it is sharded
+    statements = StatementCache()  # the compiled finder statements
+    check_deliverability = True  # look up the mail servers of email addresses
+    documents = False  # store the serialized JSON of every Pat in its doc column
 
     # Table Schema
-    id = db.Column(db.Integer, primary_key=True)
+    # DOB ranges are read in (DOB, id) order so that pages resume from an index seek,
+    # the archiver reads the deleted Pats by deletion time from a partial index
+    __table_args__ = (
+        db.Index("ix_pat_DOB_id", "DOB", "id"),
+        db.Index(
+            "ix_pat_deleted_at", "deleted_at",
+            postgresql_where=db.text("deleted_at IS NOT NULL"), sqlite_where=db.text("deleted_at IS NOT NULL"),
+        ),
+        # ids of archived Pats are never given out again
+        {"sqlite_autoincrement": True},
+    )
+
+    # 64 bit ids so that sharded ids fit, SQLite needs INTEGER to autoincrement
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
     title = db.Column(db.String(20), nullable=True)
-    fname = db.Column(db.String(60), nullable=False)
-    mname = db.Column(db.String(60), nullable=True)
-    lname = db.Column(db.String(60), nullable=False)
-    street = db.Column(db.String(60), nullable=False)
+    fname = db.Column(EncryptedString(60, deterministic=True, context="pat.fname"), nullable=False)
+    mname = db.Column(EncryptedString(60, context="pat.mname"), nullable=True)
+    lname = db.Column(EncryptedString(60, deterministic=True, context="pat.lname"), nullable=False, index=True)
+    street = db.Column(EncryptedString(60, context="pat.street"), nullable=False)
     postal_code = db.Column(db.String(10), nullable=False)
     city = db.Column(db.String(40), nullable=False)
     state = db.Column(db.String(2), nullable=False)
-    phone_home = db.Column(db.String(14), nullable=False)
-    email = db.Column(db.String(60), nullable=True)
+    phone_home = db.Column(
+        EncryptedString(14, deterministic=True, context="pat.phone_home"), nullable=False, index=True
+    )
+    email = db.Column(EncryptedString(60, context="pat.email"), nullable=True)
     DOB = db.Column(db.DateTime, nullable=False)
     #DOB = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     gender = db.Column(db.Enum(Gender), nullable=False, server_default=(Gender.Unknown.name))
     #category = db.Column(db.String(63), nullable=False)
     #eligibility = db.Column(db.Boolean(), nullable=False, default=True)
+    # Columns derived from the others on every write, rows written before a
+    # column was added get it from a backfill job (see service/backfill.py)
+    block_key = db.Column(EncryptedString(80, deterministic=True, context="pat.block_key"), nullable=True, index=True)
+    phone_normalized = db.Column(EncryptedString(14, deterministic=True, context="pat.phone_normalized"), nullable=True)
+    deleted_at = db.Column(db.DateTime, nullable=True)
+    # only read by find_documents, never loaded with the Pats
+    doc = deferred(db.Column(EncryptedString(None, context="pat.doc"), nullable=True))
     
     def __repr__(self):
         return "<Pat fname=%r lname=%r id=[%s]>" % (self.fname, self.lname, self.id)
@@ -91,26 +181,67 @@ class Pat(db.Model):
         Creates a new Pat to the database
         """
         logger.info("Creating %s %s", self.fname, self.lname)
-        self.id = None  # id must be none to generate next primary key
-        db.session.add(self)
-        db.session.commit()
+        self.update_derived_columns()
+        if self.shards is not None:
+            shard = self.shards.shard_for_new(self.state)
+            self.id = self.shards.ids.next_id(shard)
+            session = self.shards.sessions[shard]
+        else:
+            self.id = None  # id must be none to generate next primary key
+            session = db.session
+        session.add(self)
+        if self.documents:
+            session.flush()  # the document holds the id
+            self.update_document()
+        session.commit()
 
     def save(self):
         """
         Updates an existing Pat to the database
         """
         logger.info("Saving %s %s", self.fname, self.lname)
-        db.session.commit()
+        self.update_derived_columns()
+        self.update_document()
+        (object_session(self) or db.session).commit()
 
     def delete(self):
-        """ Removes a Pat from the data store """
+        """ Marks a Pat deleted, the archiver later moves it out of the table """
         logger.info("Deleting %s %s", self.fname, self.lname)
-        db.session.delete(self)
-        db.session.commit()
+        self.deleted_at = datetime.utcnow()
+        self.update_document()
+        (object_session(self) or db.session).commit()
+
+    def update_derived_columns(self):
+        """ Recomputes the blocking key and the normalized phone number """
+        self.block_key = matching.block_key(self.lname, self.DOB, self.postal_code)
+        self.phone_normalized = matching.digits(self.phone_home) or None
+
+    def update_document(self):
+        """ Rewrites the stored JSON document of a Pat, or clears it when documents are disabled
+
+        A document left in place while they are disabled would be served stale
+        once they are enabled again, a cleared one is serialized on the fly
+        until the backfill stores it
+        """
+        if self.documents:
+            self.doc = self.encode_document(self.serialize())
+        else:
+            self.doc = None
+
+    @staticmethod
+    def encode_document(data):
+        """ Encodes a serialized Pat the way jsonify does """
+        return json.dumps(data, separators=(",", ":"), sort_keys=True)
+
+    def serialize(self, fields=None):
+        """ Serializes a Pat into a dictionary
 
-    def serialize(self):
-        """ Serializes a Pat into a dictionary """
-        return {
+        Args:
+            fields (list): the names of the fields to include, or None for all of them
+        """
+        if fields is not None:
+            return {name: self._serialize_field(name) for name in fields}
+        data = {
             "id": self.id,
             "title": self.title,
             "fname": self.fname,
@@ -128,6 +259,18 @@ class Pat(db.Model):
             #"eligibility": self.eligibility,
             
         }
+        if self.deleted_at is not None:
+            data["deleted_at"] = self.deleted_at.isoformat()
+        return data
+
+    def _serialize_field(self, name):
+        """ Serializes a single field of a Pat """
+        value = getattr(self, FIELD_COLUMNS[name])
+        if name == "DOB":
+            return value.strftime("%Y-%m-%d")
+        if name == "sex":
+            return value.name
+        return value
 
     def deserialize(self, data):
         """
@@ -161,7 +304,9 @@ class Pat(db.Model):
             #validate the email address
             self.email = None
             if(data.get("email")):
-                self.email = validate_email(data.get("email")).email
+                self.email = validate_email(
+                    data.get("email"), check_deliverability=self.check_deliverability
+                ).email
             
             #validate the DOB
             self.DOB = datetime.strptime(data["DOB"], "%Y-%m-%d")
@@ -170,6 +315,8 @@ class Pat(db.Model):
 
             #self.category = data["category"]
             #self.eligibility = data["eligibility"]
+
+            self.update_derived_columns()
         
         except KeyError as error:
             raise DataValidationError("Invalid patient: missing " + error.args[0])
@@ -189,93 +336,564 @@ class Pat(db.Model):
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        keyring.configure(app.config["FIELD_ENCRYPTION_KEYS"], app.config["FIELD_ENCRYPTION_CACHE_SIZE"])
+        # one worker at a time, the others then find the schema up to date
+        with schema_lock(db.engine):
+            db.create_all()  # make our sqlalchemy tables
+            cls.update_schema(db.engine)
+        cls.check_deliverability = app.config["EMAIL_CHECK_DELIVERABILITY"]
+        cls.documents = app.config["JSON_DOCUMENTS_ENABLED"]
+        cls.statements = StatementCache(app.config["STATEMENT_CACHE_SIZE"])
+        cls.shards = ShardSet.from_app(app)
+        if cls.shards is not None:
+            for engine in cls.shards.engines:
+                with schema_lock(engine):
+                    for table in (cls.__table__, ArchivedPat.__table__):
+                        table.create(engine, checkfirst=True)
+                    cls.update_schema(engine)
+
+    @classmethod
+    def update_schema(cls, engine):
+        """ Adds the new nullable columns and indexes online, backfill jobs fill them in """
+        for table in (cls.__table__, ArchivedPat.__table__, IdempotencyKey.__table__):
+            add_missing_columns(engine, table)
+            add_missing_indexes(engine, table)
+            widen_columns(engine, table)
+
+    @classmethod
+    def parse_fields(cls, fields):
+        """ Parses a comma separated fields parameter into a list of field names
+
+        Args:
+            fields (string): the requested field names, e.g. "fname,lname,DOB"
+
+        Returns None when no fields were requested, the id is always included
+        """
+        if not fields:
+            return None
+        names = ["id"]
+        for name in fields.split(","):
+            name = name.strip()
+            if name not in FIELD_COLUMNS:
+                raise DataValidationError("Invalid field: " + name)
+            if name not in names:
+                names.append(name)
+        return names
+
+    @classmethod
+    def _baked(cls, fields=None, column=None, ids=False, deleted=False, model=None, documents=False):
+        """ Returns the baked query of a finder
+
+        The statement is compiled once for each combination of fields, filter
+        column, table and sharding, and then reused with new parameter values
+
+        Args:
+            fields (list): the names of the fields to load, or None for all of them
+            column (string): the column compared with the "value" parameter, or
+                looked up in the "values" list for the searchable encrypted columns
+            ids (boolean): True to filter on the "ids" list parameter
+            deleted (boolean): True to include the deleted Pats
+            model (class): the class queried, Pat or ArchivedPat
+            documents (boolean): True to return (id, doc) rows instead of Pats
+        """
+        model = model or cls
+        if documents:
+            query = cls.statements(lambda session: session.query(model.id, model.doc), model.__name__)
+        else:
+            query = cls.statements(lambda session: session.query(model), model.__name__)
+        if fields is not None:
+            # deleted_at tells the deleted Pats that get() returns apart
+            columns = [FIELD_COLUMNS[name] for name in fields] + ["deleted_at"]
+            query.add_criteria(lambda q: q.options(load_only(*columns)), tuple(columns))
+        if column is not None and cls._searchable(column):
+            # compared as stored, the values are already in their stored forms
+            query.add_criteria(
+                lambda q: q.filter(type_coerce(getattr(model, column), String).in_(bindparam("values", expanding=True))),
+                column,
+            )
+        elif column is not None:
+            query.add_criteria(lambda q: q.filter(getattr(model, column) == bindparam("value")), column)
+        if ids:
+            query += lambda q: q.filter(model.id.in_(bindparam("ids", expanding=True)))
+        if not deleted:
+            query += lambda q: q.filter(model.deleted_at.is_(None))
+        # in id order whatever index the database picks, as the shards are merged
+        query += lambda q: q.order_by(model.id)
+        return query
 
     @classmethod
-    def all(cls):
+    def _searchable(cls, column):
+        """ Returns True for the deterministic encrypted columns, whose values have several stored forms """
+        column_type = getattr(cls, column).type
+        return isinstance(column_type, EncryptedString) and column_type.deterministic
+
+    @classmethod
+    def _dob_baked(cls, fields=None, dob_from=False, dob_to=False, after=False, limit=False,
+                   deleted=False, model=None):
+        """ Returns the baked query of a DOB range, in (DOB, id) order
+
+        Args:
+            fields (list): the names of the fields to load, or None for all of them
+            dob_from, dob_to (boolean): True to bound the range with the
+                "dob_from" and "dob_to" parameters
+            after (boolean): True to resume after the "after_dob", "after_id" keyset
+            limit (boolean): True to return at most "limit" rows
+            deleted (boolean): True to include the deleted Pats
+            model (class): the class queried, Pat or ArchivedPat
+        """
+        model = model or cls
+        query = cls.statements(lambda session: session.query(model), model.__name__)
+        if fields is not None:
+            # the DOB is needed for the keyset of the next page
+            columns = [FIELD_COLUMNS[name] for name in fields]
+            if "DOB" not in columns:
+                columns.append("DOB")
+            query.add_criteria(lambda q: q.options(load_only(*columns)), tuple(columns))
+        if dob_from:
+            query += lambda q: q.filter(model.DOB >= bindparam("dob_from"))
+        if dob_to:
+            query += lambda q: q.filter(model.DOB <= bindparam("dob_to"))
+        if after:
+            query += lambda q: q.filter(
+                tuple_(model.DOB, model.id) > tuple_(
+                    bindparam("after_dob", type_=model.DOB.type), bindparam("after_id", type_=model.id.type)
+                )
+            )
+        if not deleted:
+            query += lambda q: q.filter(model.deleted_at.is_(None))
+        query += lambda q: q.order_by(model.DOB, model.id)
+        if limit:
+            query += lambda q: q.limit(bindparam("limit"))
+        return query
+
+    @classmethod
+    def _select(cls, fields, column=None, value=None, ids=None, state=None, include_archived=False,
+                documents=False):
+        """ Returns a list of the Pats whose column equals the value or whose id is listed
+
+        Without sharding this is a query on the database. With sharding the
+        query runs in parallel on the shards that can hold the ids or the state
+        (all of them when neither is given) and the Pats are merged by id.
+        With include_archived the deleted and archived Pats are returned too,
+        with documents (id, doc) rows are returned instead of Pats
+        """
+        params = {}
+        if column is not None and cls._searchable(column):
+            params["values"] = getattr(cls, column).type.search_values(value)
+        elif column is not None:
+            params["value"] = value
+        if ids is not None:
+            params["ids"] = list(ids)
+        shards = None if cls.shards is None else cls.shards.shards_for(ids=ids, state=state)
+        pats = cls._run(cls._baked(fields, column, ids is not None, include_archived, None, documents), params, shards)
+        if include_archived:
+            archived = cls._run(
+                cls._baked(fields, column, ids is not None, True, ArchivedPat, documents), params, shards
+            )
+            pats = list(heapq.merge(pats, archived, key=lambda pat: pat.id))
+        return pats
+
+    @classmethod
+    def _run(cls, query, params, shards=None, key=None):
+        """ Runs a baked query on the database, or on the shards merging the rows by key """
+        if cls.shards is None:
+            return query(db.session()).params(**params).all()
+        return cls.shards.scatter(lambda session: query(session).params(**params), shards, key=key)
+
+    @classmethod
+    def all(cls, fields=None, include_archived=False):
         """ Returns all of the Pats in the database """
         logger.info("Processing all Pats")
-        return cls.query.all()
+        return cls._select(fields, include_archived=include_archived)
+
+    @classmethod
+    def find_documents(cls, column=None, value=None, include_archived=False):
+        """ Returns the JSON documents of the Pats whose column equals the value (all without a column)
+
+        The stored documents are returned as they are, in id order, the Pats
+        written before documents were enabled are loaded and serialized
+
+        Args:
+            column (string): the column to match, e.g. "lname", or None for all of the Pats
+            value: the value of the column
+            include_archived (boolean): True to return the deleted and archived Pats too
+        """
+        logger.info("Processing document query for %s ...", column)
+        state = value if column == "state" else None
+        rows = cls._select(None, column, value, state=state, include_archived=include_archived, documents=True)
+        missing = [row.id for row in rows if row.doc is None]
+        pats = cls.find_many(missing, include_archived=include_archived) if missing else {}
+        return [
+            row.doc if row.doc is not None else cls.encode_document(pats[row.id].serialize())
+            for row in rows if row.doc is not None or row.id in pats
+        ]
 
     @classmethod
-    def find(cls, pat_id):
-        """ Finds a Pat by the ID """
+    def find(cls, pat_id, fields=None, include_archived=False):
+        """ Finds a Pat by the ID
+
+        Args:
+            pat_id (int): the id of the Pat
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to find a deleted or archived Pat too
+        """
         logger.info("Processing lookup for id %s ...", pat_id)
-        return cls.query.get(pat_id)
+        if cls.shards is None:
+            session = db.session()
+        else:
+            session = cls.shards.session_for_id(pat_id)
+            if session is None:
+                return None
+            session = session()
+        # get() takes no filter, the deleted Pats are told apart afterwards
+        pat = cls._baked(fields, deleted=True)(session).get(pat_id)
+        if pat is None and include_archived:
+            return cls._baked(fields, deleted=True, model=ArchivedPat)(session).get(pat_id)
+        if pat is not None and pat.deleted_at is not None and not include_archived:
+            return None
+        return pat
+
+    @classmethod
+    def find_many(cls, pat_ids, chunk_size=500, known=None, fields=None, include_archived=False):
+        """ Finds the Pats for a list of IDs with chunked IN queries
+
+        Args:
+            pat_ids (list): the ids of the Pats you want to look up
+            chunk_size (int): the most ids sent in a single IN query
+            known (dict): Pats already resolved by id (e.g. from a read cache),
+                only the remaining ids are queried
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to find the deleted and archived Pats too
+
+        Returns a dictionary of the Pats that were found keyed by id
+        """
+        logger.info("Processing batch lookup for %d ids ...", len(pat_ids))
+        found = dict(known or {})
+        missing = [pat_id for pat_id in dict.fromkeys(pat_ids) if pat_id not in found]
+        for start in range(0, len(missing), chunk_size):
+            for pat in cls._select(fields, ids=missing[start:start + chunk_size], include_archived=include_archived):
+                found[pat.id] = pat
+        return found
 
     @classmethod
     def find_or_404(cls, pat_id):
         """ Find a Pat by the ID and return Not Found status code """
         logger.info("Processing lookup or 404 for id %s ...", pat_id)
-        return cls.query.get_or_404(pat_id)
+        pat = cls.find(pat_id)
+        if pat is None:
+            abort(404)
+        return pat
 
     @classmethod
-    def find_by_lname(cls, lname):
+    def find_by_lname(cls, lname, fields=None, include_archived=False):
         """ Returns all Pats with the given name
 
         Args:
             name (string): the last name of Pats you want to match
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
         """
         logger.info("Processing name query for %s ...", lname)
-        return cls.query.filter(cls.lname == lname)
+        return cls._select(fields, "lname", lname, include_archived=include_archived)
 
     @classmethod
-    def find_by_fname(cls, fname):
+    def find_by_fname(cls, fname, fields=None, include_archived=False):
         """ Returns all Pats with the given name
 
         Args:
             name (string): the first name of Pats you want to match
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
         """
         logger.info("Processing name query for %s ...", fname)
-        return cls.query.filter(cls.fname == fname)
+        return cls._select(fields, "fname", fname, include_archived=include_archived)
 
     @classmethod
-    def find_by_phone(cls, phone_home):
+    def find_by_phone(cls, phone_home, fields=None, include_archived=False):
         """ Returns the Pat having the home phone number
 
         Args:
             phone_home (string): the home phone of the Pat you want to match
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
         """
         logger.info("Processing phone query for %s ...", phone_home)
-        return cls.query.filter(cls.phone_home== phone_home)
+        return cls._select(fields, "phone_home", phone_home, include_archived=include_archived)
 
     @classmethod
-    def find_by_zip(cls, postal_code):
+    def find_by_zip(cls, postal_code, fields=None, include_archived=False):
         """ Returns all of the Pats having the zip code
 
         Args:
             postal_code (string): the zip code of the Pat you want to match
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
         """
         logger.info("Processing zip code query for %s ...", postal_code)
-        return cls.query.filter(cls.postal_code == postal_code)
+        return cls._select(fields, "postal_code", postal_code, include_archived=include_archived)
+
+
+    @classmethod
+    def find_by_state(cls, state, fields=None, include_archived=False):
+        """ Returns all of the Pats living in a state
 
+        Args:
+            state (string): the state of the Pats you want to match
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
+        """
+        logger.info("Processing state query for %s ...", state)
+        return cls._select(fields, "state", state, state=state, include_archived=include_archived)
 
     @classmethod
-    def find_by_category(cls, category):
+    def find_duplicates(cls, pat):
+        """ Returns the other Pats sharing the blocking key of a Pat
+
+        Args:
+            pat (Pat): the Pat whose likely duplicates you want to find
+        """
+        logger.info("Processing duplicate query for id %s ...", pat.id)
+        if pat.block_key is None:
+            return []
+        return [other for other in cls._select(None, "block_key", pat.block_key) if other.id != pat.id]
+
+    @classmethod
+    def blocks(cls, batch_size=1000):
+        """ Yields the Pats grouped by blocking key, reading the table in key order
+
+        Only the fields compared by the matching are loaded, and the rows are
+        streamed in batches (merged across the shards) so that the whole table
+        is never held in memory. The streams are merged and grouped on the key
+        as stored, in byte order, since with encryption the databases return
+        the rows in the order of the ciphertexts. The rows whose key is stored
+        in another form (in plaintext or under an older key) are read ahead
+        and added to the block of their key, until they are rewritten they
+        are the ones held in memory
+
+        Yields (block key, list of Pats) tuples
+        """
+        logger.info("Processing blocks of all Pats")
+        if cls.shards is None:
+            sessions = [db.session()]
+        else:
+            sessions = [session() for session in cls.shards.sessions]
+        stored = type_coerce(cls.block_key, String)
+        current = stored.startswith("{}{}:".format(PREFIX, keyring.current), autoescape=True)
+
+        def query(session):
+            return (
+                session.query(cls, stored.label("stored"))
+                .options(load_only("id", "block_key", "fname", "phone_home", "email", "street"))
+                .filter(cls.block_key.isnot(None), cls.deleted_at.is_(None))
+            )
+
+        others = {}
+        if keyring.enabled:
+            for session in sessions:
+                for pat, _ in query(session).filter(~current).yield_per(batch_size):
+                    others.setdefault(pat.block_key, []).append(pat)
+        streams = []
+        for session in sessions:
+            rows = query(session).filter(current) if keyring.enabled else query(session)
+            # the merge compares the keys in Python, PostgreSQL sorts them by its collation
+            order = stored.collate("C") if session.get_bind(cls.__mapper__).dialect.name == "postgresql" else stored
+            streams.append(rows.order_by(order, cls.id).yield_per(batch_size))
+        rows = heapq.merge(*streams, key=lambda row: row.stored)
+        for _, group in itertools.groupby(rows, key=lambda row: row.stored):
+            pats = [pat for pat, _ in group]
+            key = pats[0].block_key
+            yield key, sorted(pats + others.pop(key, []), key=lambda pat: pat.id)
+        for key in sorted(others):
+            yield key, sorted(others[key], key=lambda pat: pat.id)
+
+    @classmethod
+    def find_by_dob_range(cls, dob_from=None, dob_to=None, limit=None, after=None, fields=None,
+                          include_archived=False):
+        """ Returns the Pats born in a date range, ordered by DOB and id
+
+        Args:
+            dob_from (datetime): the earliest date of birth, or None for no bound
+            dob_to (datetime): the latest date of birth (inclusive), or None for no bound
+            limit (int): the most Pats returned, or None for all of them
+            after (tuple): the (DOB, id) of the last Pat of the previous page
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
+        """
+        logger.info("Processing DOB range query for %s - %s ...", dob_from, dob_to)
+        bounds = (dob_from is not None, dob_to is not None, after is not None, limit is not None)
+        params = {}
+        if dob_from is not None:
+            params["dob_from"] = dob_from
+        if dob_to is not None:
+            params["dob_to"] = dob_to
+        if after is not None:
+            params["after_dob"], params["after_id"] = after
+        if limit is not None:
+            params["limit"] = limit
+        # every shard (and the archive) returns its first page, the merge keeps the overall first one
+        key = lambda pat: (pat.DOB, pat.id)
+        pats = cls._run(cls._dob_baked(fields, *bounds, deleted=include_archived), params, key=key)
+        if include_archived:
+            archived = cls._run(cls._dob_baked(fields, *bounds, deleted=True, model=ArchivedPat), params, key=key)
+            pats = list(heapq.merge(pats, archived, key=key))
+        return pats if limit is None else pats[:limit]
+
+    @classmethod
+    def find_by_age(cls, age_min=None, age_max=None, limit=None, after=None, fields=None, today=None,
+                    include_archived=False):
+        """ Returns the Pats in an age band, ordered by DOB and id
+
+        Args:
+            age_min (int): the youngest age in years, or None for no bound
+            age_max (int): the oldest age in years (inclusive), or None for no bound
+            limit (int): the most Pats returned, or None for all of them
+            after (tuple): the (DOB, id) of the last Pat of the previous page
+            fields (list): the names of the fields to load, or None for all of them
+            today (date): the day the ages are computed on, today if None
+            include_archived (boolean): True to return the deleted and archived Pats too
+        """
+        dob_from, dob_to = cls.dob_bounds(age_min, age_max, today)
+        return cls.find_by_dob_range(dob_from, dob_to, limit, after, fields, include_archived)
+
+    @staticmethod
+    def dob_bounds(age_min=None, age_max=None, today=None):
+        """ Returns the (dob_from, dob_to) range of the birth dates in an age band """
+        today = today or date.today()
+        dob_from = dob_to = None
+        if age_max is not None:
+            # born the day after the (age_max + 1)th birthday would be reached today
+            dob_from = _years_before(today, age_max + 1) + timedelta(days=1)
+        if age_min is not None:
+            dob_to = _years_before(today, age_min)
+        return dob_from, dob_to
+
+    @classmethod
+    def find_by_category(cls, category, fields=None, include_archived=False):
         """ Returns all of the Pats in a category
 
         Args:
             category (string): the category of the Pats you want to match
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
         """
         logger.info("Processing category query for %s ...", category)
-        return cls.query.filter(cls.category == category)
+        return cls._select(fields, "category", category, include_archived=include_archived)
 
     @classmethod
-    def find_by_eligibility(cls, eligibility=True):
+    def find_by_eligibility(cls, eligibility=True, fields=None, include_archived=False):
         """ Returns all Pats by their eligibility
 
         Args:
             eligibility (boolean): True for Pats that are eligible
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
         """
         logger.info("Processing eligibility query for %s ...", eligibility)
-        return cls.query.filter(cls.eligibility == eligibility)
+        return cls._select(fields, "eligibility", eligibility, include_archived=include_archived)
 
     @classmethod
-    def find_by_gender(cls, gender=Gender.Unknown):
+    def find_by_gender(cls, gender=Gender.Unknown, fields=None, include_archived=False):
         """ Returns all Pats by their Gender
 
         Args:
             Gender (enum): Options are ['Male', 'Female', 'Unknown']
+            fields (list): the names of the fields to load, or None for all of them
+            include_archived (boolean): True to return the deleted and archived Pats too
         """
         logger.info("Processing gender query for %s ...", gender.name)
-        return cls.query.filter(cls.gender == gender)
+        return cls._select(fields, "gender", gender, include_archived=include_archived)
+
+
+def _years_before(day, years):
+    """ Returns the date some years before a day as a datetime, Feb 29 becomes Feb 28 """
+    try:
+        day = day.replace(year=day.year - years)
+    except ValueError:
+        day = day.replace(year=day.year - years, day=28)
+    return datetime(day.year, day.month, day.day)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the outcome of a request sent with an Idempotency-Key
+
+    A row without a status code belongs to a request that is still running
+    """
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    location = db.Column(db.String(255), nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)  # when the request last started running
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<IdempotencyKey key=%r status_code=%s>" % (self.key, self.status_code)
+
+
+class LoadCheckpoint(db.Model):
+    """
+    Class that represents a chunk of an input file loaded by the bulk loader
+
+    The row is written in the transaction that inserts the chunk's patients,
+    so a chunk with a checkpoint is loaded exactly once
+    """
+
+    source = db.Column(db.String(255), primary_key=True)
+    chunk = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    loaded = db.Column(db.Integer, nullable=False)
+    rejected = db.Column(db.Integer, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<LoadCheckpoint source=%r chunk=%s>" % (self.source, self.chunk)
+
+
+class BackfillJob(db.Model):
+    """
+    Class that represents the progress of a backfill job on a database
+
+    The shard is 0 without sharding. The rows up to last_id are done
+    """
+
+    name = db.Column(db.String(63), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False, default=0)
+    status = db.Column(db.String(10), nullable=False, default="running")  # running, paused or done
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)
+    rows = db.Column(db.BigInteger, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<BackfillJob name=%r shard=%s status=%s last_id=%s>" % (
+            self.name, self.shard, self.status, self.last_id)
+
+
+class ArchivedPat(db.Model):
+    """
+    Class that represents a deleted Pat moved to the archive table
+
+    The archive table has the columns of the pat table (encrypted alike, so
+    the archiver copies the rows as they are) without their indexes but the
+    primary key, plus the time a row was archived. It is only read for audits
+    """
+
+    __table__ = db.Table(
+        "pat_archive", db.metadata,
+        *[
+            db.Column(column.name, column.type.copy(), primary_key=column.primary_key,
+                      nullable=column.nullable, autoincrement=False)
+            for column in Pat.__table__.columns
+        ],
+        db.Column("archived_at", db.DateTime, nullable=False, default=datetime.utcnow)
+    )
+
+    doc = deferred(__table__.c.doc)
+
+    serialize = Pat.serialize
+    _serialize_field = Pat._serialize_field
+
+    def __repr__(self):
+        return "<ArchivedPat fname=%r lname=%r id=[%s]>" % (self.fname, self.lname, self.id)
@@ -0,0 +1,147 @@
+# License info goes here.
+
+"""
+Per Request SQL Profiling
+
+Records every SQL statement a request runs, with its parameters and its
+duration. Profiling is turned on for all requests by SQL_PROFILE_ENABLED or
+for a single request by the SQL_PROFILE_HEADER header, whose value must be
+the SQL_PROFILE_TOKEN (without a token the header is ignored, as anyone could
+make the service EXPLAIN its queries). Statements slower than
+SQL_SLOW_QUERY_MS also get their EXPLAIN plan captured.
+
+The statements run on the shards by the scatter threads have no request
+context, so they are not profiled.
+
+The totals of a profiled request are returned in a Server-Timing header and
+the details of the last SQL_PROFILE_BUFFER_SIZE profiled requests are kept
+in a ring buffer for the /debug/queries endpoint. Requests that are not
+profiled only pay for one attribute lookup per statement.
+"""
+import hmac
+import time
+import logging
+from collections import deque
+from datetime import date, datetime
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("service.profiling")
+
+# How each dialect asks for the plan of a statement
+EXPLAIN_PREFIXES = {
+    "postgresql": "EXPLAIN ",
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "mysql": "EXPLAIN ",
+}
+
+# Transaction control statements, which are not counted as queries
+TRANSACTION_STATEMENTS = ("BEGIN", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+class QueryProfiler:
+    """ Collects the SQL statements run by profiled requests """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.history = deque()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Hooks the profiler into the app and into every SQLAlchemy engine """
+        self.app = app
+        self.history = deque(maxlen=app.config["SQL_PROFILE_BUFFER_SIZE"])
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        if not event.contains(Engine, "before_cursor_execute", self.before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def start(self):
+        """ Starts profiling the current request when asked to """
+        if self.app.config["SQL_PROFILE_ENABLED"] or self.requested():
+            request.sql_profile = []
+            request.sql_profile_started = time.perf_counter()
+
+    def requested(self):
+        """ Checks that the request asks for profiling with the configured token """
+        token = self.app.config["SQL_PROFILE_TOKEN"]
+        sent = request.headers.get(self.app.config["SQL_PROFILE_HEADER"])
+        return bool(token and sent) and hmac.compare_digest(sent.encode("utf-8"), token.encode("utf-8"))
+
+    @staticmethod
+    def current_profile():
+        """ Returns the statements of the current request, None when it is not profiled """
+        if not has_request_context():
+            return None
+        return getattr(request, "sql_profile", None)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.current_profile() is not None:
+            conn.info.setdefault("sql_profile_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self.current_profile()
+        if profile is None or not conn.info.get("sql_profile_started"):
+            return
+        duration = (time.perf_counter() - conn.info["sql_profile_started"].pop()) * 1000
+        if statement.lstrip().upper().startswith(TRANSACTION_STATEMENTS):
+            return
+        entry = {
+            "statement": statement,
+            "parameters": jsonable(parameters),
+            "duration_ms": round(duration, 3),
+        }
+        if duration >= self.app.config["SQL_SLOW_QUERY_MS"] and not executemany:
+            entry["plan"] = self.explain(conn, statement, parameters)
+            logger.warning("Slow query (%.1f ms): %s", duration, statement)
+        profile.append(entry)
+
+    @staticmethod
+    def explain(conn, statement, parameters):
+        """ Captures the plan of a statement on a cursor of its own """
+        prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+        if prefix is None or not statement.lstrip().upper().startswith("SELECT"):
+            return None
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+        except Exception as error:
+            return ["EXPLAIN failed: {}".format(error)]
+        finally:
+            cursor.close()
+
+    def finish(self, response):
+        """ Reports the statements of a profiled request """
+        profile = self.current_profile()
+        if profile is None:
+            return response
+        total = sum(entry["duration_ms"] for entry in profile)
+        response.headers.add(
+            "Server-Timing", 'db;dur={:.3f};desc="{} queries"'.format(total, len(profile))
+        )
+        self.history.append({
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": response.status_code,
+            "duration_ms": round((time.perf_counter() - request.sql_profile_started) * 1000, 3),
+            "db_duration_ms": round(total, 3),
+            "queries": profile,
+        })
+        return response
+
+
+def jsonable(parameters):
+    """ Converts statement parameters into values that JSON can encode """
+    if isinstance(parameters, dict):
+        return {key: jsonable(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [jsonable(value) for value in parameters]
+    if isinstance(parameters, (date, datetime)):
+        return parameters.isoformat()
+    if parameters is None or isinstance(parameters, (str, int, float, bool)):
+        return parameters
+    return str(parameters)
@@ -0,0 +1,191 @@
+# License info goes here.
+
+"""
+Rate Limiting and Admission Control
+
+Every request belongs to a cost class ("cheap" id lookups and writes,
+"expensive" list and export calls) and is admitted in two steps:
+
+1. A token bucket per client and cost class limits the request rate. The
+   buckets live in a backend: MemoryBackend keeps them in the worker process,
+   RedisBackend shares them between all workers and hosts.
+2. A concurrency limiter caps how many requests of each class a worker runs
+   at the same time, so expensive calls cannot take every worker thread. A
+   streamed response holds its slot until its body has been sent.
+
+Rejected requests raise RateLimitExceeded, which the service turns into a
+429 Too Many Requests with a Retry-After header.
+"""
+import math
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+
+# The URI schemes of the storages RedisBackend connects to
+REDIS_SCHEMES = ("redis", "rediss", "unix")
+
+
+class RateLimitExceeded(Exception):
+    """ Used when a client has to back off before sending more requests """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitBackend:
+    """ Base class for the stores that keep the token buckets """
+
+    def take(self, key, rate, burst, cost=1):
+        """
+        Takes tokens from a bucket
+
+        Args:
+            key (string): the bucket to take from
+            rate (float): the tokens added to the bucket per second
+            burst (int): the most tokens the bucket holds
+            cost (int): the tokens needed by the request
+
+        Returns the number of seconds to wait before retrying, 0 if admitted
+        """
+        raise NotImplementedError
+
+
+class MemoryBackend(RateLimitBackend):
+    """ Keeps the token buckets in the memory of the worker process """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            # forget the least recently seen clients
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBackend(RateLimitBackend):
+    """ Keeps the token buckets in Redis so that all workers share them """
+
+    SCRIPT = """
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= cost then
+            tokens = tokens - cost
+        else
+            wait = (cost - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, client, prefix="ratelimit:"):
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    @classmethod
+    def from_url(cls, url):
+        """ Creates the backend from a redis://, rediss:// or unix:// URL """
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def take(self, key, rate, burst, cost=1):
+        return float(self._script(keys=[self.prefix + key], args=[rate, burst, cost, time.time()]))
+
+
+class ConcurrencyLimiter:
+    """ Caps the number of requests of each cost class running at once """
+
+    def __init__(self, limits):
+        self._slots = {name: threading.BoundedSemaphore(limit) for name, limit in limits.items()}
+
+    def acquire(self, cost_class):
+        """ Takes a slot without waiting, returns False when none is free """
+        return self._slots[cost_class].acquire(blocking=False)
+
+    def release(self, cost_class):
+        """ Gives a slot back """
+        self._slots[cost_class].release()
+
+
+class RateLimiter:
+    """ Admits or rejects requests by client and cost class """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.concurrency = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Creates the backend and the concurrency limiter from the app config """
+        url = app.config["RATE_LIMIT_STORAGE_URI"]
+        scheme = url.partition("://")[0]
+        if scheme in REDIS_SCHEMES:
+            self.backend = RedisBackend.from_url(url)
+        elif scheme == "memory":
+            self.backend = MemoryBackend()
+        else:
+            raise ValueError("Unknown rate limit storage URI: {}".format(url))
+        self.concurrency = ConcurrencyLimiter(app.config["CONCURRENCY_LIMITS"])
+
+    @staticmethod
+    def client_key():
+        """ Identifies the client by its API key, or by its address without one """
+        api_key = request.headers.get(current_app.config["RATE_LIMIT_KEY_HEADER"])
+        return "key:" + api_key if api_key else "addr:" + (request.remote_addr or "-")
+
+    def check_rate(self, cost_class):
+        """ Takes a token for the current request or raises RateLimitExceeded """
+        rate, burst = current_app.config["RATE_LIMITS"][cost_class]
+        wait = self.backend.take("{}:{}".format(self.client_key(), cost_class), rate, burst)
+        if wait > 0:
+            raise RateLimitExceeded(
+                "Rate limit exceeded for {} requests".format(cost_class), math.ceil(wait)
+            )
+
+    def limit(self, cost_class):
+        """ Decorator that applies both limits to a route """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not current_app.config["RATE_LIMIT_ENABLED"]:
+                    return function(*args, **kwargs)
+                self.check_rate(cost_class)
+                if not self.concurrency.acquire(cost_class):
+                    raise RateLimitExceeded(
+                        "Too many {} requests in progress".format(cost_class),
+                        current_app.config["CONCURRENCY_RETRY_AFTER"],
+                    )
+                try:
+                    response = current_app.make_response(function(*args, **kwargs))
+                except BaseException:
+                    self.concurrency.release(cost_class)
+                    raise
+                if response.is_streamed:
+                    # the body is produced after the view returned, keep the slot until it is sent
+                    response.call_on_close(lambda: self.concurrency.release(cost_class))
+                else:
+                    self.concurrency.release(cost_class)
+                return response
+            return wrapper
+        return decorator
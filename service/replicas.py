@@ -0,0 +1,223 @@
+# License info goes here.
+
+"""
+Read Replica Routing
+
+Sends the reads of GET requests to read replicas and everything else to the
+primary database. Replicas are listed in SQLALCHEMY_REPLICA_URIS and become
+the Flask-SQLAlchemy binds "replica0", "replica1", ...
+
+A replica is only used while its last health check passed and its
+replication lag stays under REPLICA_MAX_LAG_SECONDS, otherwise reads fall
+back to the other replicas and finally to the primary. After a client writes,
+its reads stay on the primary for READ_YOUR_WRITES_SECONDS so that it sees
+its own changes. The worker that served the write remembers the client, and
+the response sets the READ_YOUR_WRITES_COOKIE cookie to the time the
+stickiness ends, so that the next request keeps reading from the primary
+whichever worker or host serves it.
+"""
+import math
+import time
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, text
+
+logger = logging.getLogger("service.replicas")
+
+# Replication lag of a PostgreSQL standby, 0 when it has replayed everything
+POSTGRES_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class ReplicaRouter:
+    """ Picks the engine that serves the reads of the current request """
+
+    def __init__(self):
+        self.app = None
+        self.names = []
+        self._health = {}
+        self._checking = set()
+        self._sticky = OrderedDict()
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+
+    def init_app(self, app):
+        """ Registers the replicas of the app as Flask-SQLAlchemy binds """
+        self.app = app
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        for name in self.names:
+            binds.pop(name, None)
+        self.names = []
+        for index, uri in enumerate(app.config.get("SQLALCHEMY_REPLICA_URIS") or []):
+            name = "replica{}".format(index)
+            binds[name] = uri
+            self.names.append(name)
+        app.config["SQLALCHEMY_BINDS"] = binds
+        self._health = {}
+        self._checking = set()
+        self._sticky.clear()
+
+    # The routing is kept on the request rather than on g, because the app
+    # context pushed by Pat.init_db outlives the requests
+
+    def read_from_replica(self, enabled=True):
+        """ Routes the reads of the current request to a replica or to the primary """
+        request.read_from_replica = enabled and bool(self.names)
+
+    def reading_from_replica(self):
+        """ Checks that the current request reads from a replica """
+        return has_request_context() and getattr(request, "read_from_replica", False)
+
+    def mark_write(self, client, response=None):
+        """ Keeps the reads of a client on the primary after it wrote
+
+        Args:
+            client (string): the client key of the writer
+            response (Response): gets the cookie that carries the stickiness to the other workers
+        """
+        if not self.names:
+            return
+        seconds = self.app.config["READ_YOUR_WRITES_SECONDS"]
+        with self._lock:
+            self._sticky.pop(client, None)
+            self._sticky[client] = time.monotonic() + seconds
+            while len(self._sticky) > self.app.config["READ_YOUR_WRITES_MAX_CLIENTS"]:
+                self._sticky.popitem(last=False)
+        if response is not None:
+            response.set_cookie(
+                self.app.config["READ_YOUR_WRITES_COOKIE"], "{:.3f}".format(time.time() + seconds),
+                max_age=int(math.ceil(seconds)), httponly=True,
+            )
+
+    def is_sticky(self, client):
+        """ Checks that a client wrote recently enough to read from the primary """
+        if self.has_sticky_cookie():
+            return True
+        expires = self._sticky.get(client)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            with self._lock:
+                self._sticky.pop(client, None)
+            return False
+        return True
+
+    def has_sticky_cookie(self):
+        """ Checks the cookie set by a write that another worker may have served """
+        if not self.names or not has_request_context():
+            return False
+        try:
+            until = float(request.cookies.get(self.app.config["READ_YOUR_WRITES_COOKIE"], ""))
+        except ValueError:
+            return False
+        now = time.time()
+        # a forged cookie cannot pin a client to the primary for longer
+        return now <= until <= now + self.app.config["READ_YOUR_WRITES_SECONDS"]
+
+    def replica_engine(self, db):
+        """ Returns the replica of the current request, or None to use the primary """
+        if not hasattr(request, "replica_engine"):
+            request.replica_engine = self.pick_replica(db)
+        return request.replica_engine
+
+    def pick_replica(self, db):
+        """ Returns the engine of a healthy replica, or None when there is none """
+        healthy = [name for name in self.names if self.is_healthy(db, name)]
+        if not healthy:
+            return None
+        return db.get_engine(self.app, bind=healthy[next(self._next) % len(healthy)])
+
+    def is_healthy(self, db, name):
+        """ Checks a replica, reusing the last result for REPLICA_HEALTH_INTERVAL
+
+        One thread runs a due check, outside the lock so that a slow replica
+        does not hold up the routing, while the others use the last result
+        """
+        checked, healthy = self._health.get(name, (None, False))
+        now = time.monotonic()
+        if checked is not None and now - checked < self.app.config["REPLICA_HEALTH_INTERVAL"]:
+            return healthy
+        with self._lock:
+            if name in self._checking:
+                return healthy
+            self._checking.add(name)
+        try:
+            healthy = self.check(db.get_engine(self.app, bind=name), name)
+        finally:
+            with self._lock:
+                self._checking.discard(name)
+        self._health[name] = (now, healthy)
+        return healthy
+
+    def max_lag(self, db):
+        """ Returns the largest replication lag in seconds of the reachable replicas """
+        lags = [0.0]
+        for name in self.names:
+            try:
+                lags.append(self.lag(db.get_engine(self.app, bind=name)))
+            except Exception as error:
+                logger.warning("Replica %s failed its lag check: %s", name, error)
+        return max(lags)
+
+    @staticmethod
+    def lag(engine):
+        """ Returns the replication lag of a replica in seconds """
+        with engine.connect() as connection:
+            if engine.dialect.name == "postgresql":
+                return float(connection.execute(POSTGRES_LAG_QUERY).scalar() or 0)
+            connection.execute(text("SELECT 1"))
+            return 0.0
+
+    def check(self, engine, name):
+        """ Runs the health check of a replica """
+        try:
+            lag = self.lag(engine)
+        except Exception as error:
+            logger.warning("Replica %s failed its health check: %s", name, error)
+            return False
+        if lag > self.app.config["REPLICA_MAX_LAG_SECONDS"]:
+            logger.warning("Replica %s is %.1f seconds behind, reading from the primary", name, lag)
+            return False
+        return True
+
+
+class RoutingSession(SignallingSession):
+    """ Session that sends the reads of GET requests to a replica """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and self.db.router.reading_from_replica():
+            engine = self.db.router.replica_engine(self.db)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy extension with read replica routing """
+
+    def __init__(self, *args, **kwargs):
+        self.router = ReplicaRouter()
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        self.router.init_app(app)
+        super().init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def dispose_engines(self, app):
+        """ Closes the pooled connections of the primary and of the replicas """
+        self.get_engine(app).dispose()
+        for name in self.router.names:
+            self.get_engine(app, bind=name).dispose()
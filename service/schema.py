@@ -0,0 +1,184 @@
+# License info goes here.
+
+"""
+Online Schema Changes
+
+db.create_all() only creates missing tables, so columns added to a model
+never reach a table that already holds data. add_missing_columns adds them
+without taking the table offline: a nullable column without a default is a
+catalog change (no table rewrite). add_missing_indexes builds the indexes
+added to a model with CREATE INDEX CONCURRENTLY on PostgreSQL so that writes
+go on meanwhile. The rows already in the table get their values from a
+backfill job.
+
+Every worker that imports the app runs these on start. On PostgreSQL they
+run under an advisory lock (schema_lock) with IF NOT EXISTS, and an index
+left INVALID by a failed concurrent build is dropped and built again. On
+SQLite a column or index another process added meanwhile is skipped.
+"""
+import logging
+from contextlib import contextmanager
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger("service.schema")
+
+# Key of the PostgreSQL advisory lock held while the schema is changed
+SCHEMA_LOCK_KEY = 7246501
+
+# Indexes of a table left INVALID by a failed CREATE INDEX CONCURRENTLY
+POSTGRES_INVALID_INDEXES = text(
+    "SELECT index_class.relname FROM pg_index "
+    "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+    "JOIN pg_class table_class ON table_class.oid = pg_index.indrelid "
+    "WHERE table_class.relname = :table AND NOT pg_index.indisvalid"
+)
+
+
+class SchemaError(Exception):
+    """ Used for a column that cannot be added online """
+    pass
+
+
+def missing_columns(engine, table):
+    """ Returns the columns of a table that its database table lacks """
+    inspector = inspect(engine)
+    if table.name not in inspector.get_table_names():
+        return []
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    return [column for column in table.columns if column.name not in existing]
+
+
+def add_missing_columns(engine, table):
+    """
+    Adds the columns of a table that the database lacks
+
+    Returns the names of the columns added
+    """
+    columns = missing_columns(engine, table)
+    for column in columns:
+        if not column.nullable or column.server_default is not None:
+            raise SchemaError("Column {}.{} must be nullable without a default to be added online".format(
+                table.name, column.name))
+    return [column.name for column in columns if add_column(engine, table, column)]
+
+
+def add_column(engine, table, column):
+    """ Adds a column to a table, returns False when another process added it first """
+    preparer = engine.dialect.identifier_preparer
+    # SQLite has no ADD COLUMN IF NOT EXISTS
+    if_not_exists = "IF NOT EXISTS " if engine.dialect.name == "postgresql" else ""
+    logger.info("Adding column %s.%s", table.name, column.name)
+    try:
+        with engine.begin() as connection:
+            connection.execute("ALTER TABLE {} ADD COLUMN {}{} {}".format(
+                preparer.format_table(table), if_not_exists, preparer.format_column(column),
+                column.type.compile(dialect=engine.dialect),
+            ))
+    except DBAPIError:
+        if column.name not in {existing["name"] for existing in inspect(engine).get_columns(table.name)}:
+            raise
+        logger.info("Column %s.%s was added by another process", table.name, column.name)
+        return False
+    return True
+
+
+def add_missing_indexes(engine, table):
+    """ Builds the indexes of a table that the database lacks, or that are invalid, returns their names """
+    inspector = inspect(engine)
+    if table.name not in inspector.get_table_names():
+        return []
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    for name in invalid_indexes(engine, table):
+        if name in {index.name for index in table.indexes}:
+            logger.warning("Dropping the invalid index %s to build it again", name)
+            drop_index(engine, name)
+            existing.discard(name)
+    added = []
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if index.name not in existing:
+            logger.info("Creating index %s", index.name)
+            create_index(engine, index)
+            added.append(index.name)
+    return added
+
+
+def invalid_indexes(engine, table):
+    """ Returns the names of the indexes of a table that a failed concurrent build left invalid """
+    if engine.dialect.name != "postgresql":
+        return []
+    with engine.connect() as connection:
+        return [row[0] for row in connection.execute(POSTGRES_INVALID_INDEXES, table=table.name)]
+
+
+def drop_index(engine, name):
+    """ Drops an index without blocking the writes to its table """
+    statement = "DROP INDEX CONCURRENTLY IF EXISTS {}".format(engine.dialect.identifier_preparer.quote(name))
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").execute(statement)
+
+
+@contextmanager
+def schema_lock(engine):
+    """
+    Lets one process at a time change the schema of a PostgreSQL database
+
+    The advisory lock is taken on a connection of its own in autocommit mode:
+    an open transaction would make CREATE INDEX CONCURRENTLY wait for it
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), key=SCHEMA_LOCK_KEY)
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), key=SCHEMA_LOCK_KEY)
+
+
+def widen_columns(engine, table):
+    """
+    Lengthens the string columns that the model made longer, e.g. once encrypted
+
+    Making a VARCHAR longer only changes the catalog on PostgreSQL, SQLite
+    does not enforce lengths. Returns the names of the columns widened
+    """
+    if engine.dialect.name != "postgresql":
+        return []
+    inspector = inspect(engine)
+    if table.name not in inspector.get_table_names():
+        return []
+    lengths = {column["name"]: getattr(column["type"], "length", None) for column in inspector.get_columns(table.name)}
+    preparer = engine.dialect.identifier_preparer
+    widened = []
+    for column in table.columns:
+        length = getattr(column.type, "length", None)
+        current = lengths.get(column.name)
+        if length is None or current is None or current >= length:
+            continue
+        logger.info("Widening column %s.%s to %d characters", table.name, column.name, length)
+        with engine.begin() as connection:
+            connection.execute("ALTER TABLE {} ALTER COLUMN {} TYPE {}".format(
+                preparer.format_table(table), preparer.format_column(column),
+                column.type.compile(dialect=engine.dialect),
+            ))
+        widened.append(column.name)
+    return widened
+
+
+def create_index(engine, index):
+    """ Builds an index without blocking the writes to its table, unless it exists """
+    statement = str(CreateIndex(index).compile(dialect=engine.dialect))
+    if engine.dialect.name == "postgresql":
+        # CONCURRENTLY cannot run inside a transaction
+        statement = statement.replace(" INDEX ", " INDEX CONCURRENTLY IF NOT EXISTS ", 1)
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").execute(statement)
+    else:
+        if engine.dialect.name == "sqlite":
+            statement = statement.replace(" INDEX ", " INDEX IF NOT EXISTS ", 1)
+        with engine.begin() as connection:
+            connection.execute(statement)
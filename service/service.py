@@ -7,26 +7,80 @@ Paths:
 ------
 GET /pats - Returns a list all of the patients
 GET /pats/{id} - Returns the patient with a given id number
-POST /pats - creates a new patient record in the database
+GET /pats?fields=fname,lname - Returns only the listed fields of each patient
+    The list is sent as JSON, as NDJSON (Accept: application/x-ndjson) or as
+    columnar JSON (Accept: application/vnd.pats.columnar+json). With
+    JSON_DOCUMENTS_ENABLED full JSON and NDJSON lists are assembled from the
+    stored patient documents
+GET /pats?ids=1,2,3 - Returns the patients with the given id numbers
+GET /pats?age_min=65&age_max=74 - Returns the patients in an age band (or
+    dob_from/dob_to range) a page at a time, the next page is in the Link header
+POST /pats/batch-get - Returns the patients with the id numbers in the body
+GET /pats/{id}/duplicates - Returns the likely duplicates of a patient, best match first
+GET /debug/queries - Returns the SQL statements of the last profiled requests
+GET /debug/statement-cache - Returns the use of the compiled statement cache
+GET /debug/single-flight - Returns how many identical concurrent reads were coalesced
+POST /pats - creates a new patient record in the database, once per Idempotency-Key
 PUT /pats/{id} - updates a patient record in the database
-DELETE /pats/{id} - deletes a patient record in the database
+DELETE /pats/{id} - deletes a patient record, it is archived later
+GET /pats?include_archived=true, GET /pats/{id}?include_archived=true - Also
+    returns the deleted and archived patients, for audits with the
+    ARCHIVE_AUDIT_TOKEN, lists need ids, a DOB range or a name, phone or
+    postal code filter
 """
 
 import os
 import sys
+import hmac
+import json
+import uuid
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+import click
+from datetime import datetime
+from flask.cli import AppGroup
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, stream_with_context
 from flask_api import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Pat, DataValidationError, Gender
+from service.models import Pat, DataValidationError, Gender, db
+from service.compression import compress_response
+from service.ratelimit import RateLimiter, RateLimitExceeded
+from service.profiling import QueryProfiler
+from service.idempotency import IdempotencyStore
+from service.singleflight import SingleFlight
+from service.matching import similarity, candidate_pairs
+from service import loader, backfill, archive
 
 # Import Flask application
 from . import app
 
+# Representations of a patient list that clients can ask for with Accept
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+COLUMNAR_JSON = "application/vnd.pats.columnar+json"
+# The oldest age accepted in an age band
+MAX_AGE = 150
+
+# The client address behind trusted proxies, which the limiter keys on
+if app.config["TRUSTED_PROXY_HOPS"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXY_HOPS"])
+
+# Admission control for the routes by cost class
+limiter = RateLimiter(app)
+
+# Opt-in SQL profiling of requests
+profiler = QueryProfiler(app)
+
+# Identical reads in flight at the same time share one database call
+single_flight = SingleFlight(app)
+
+# Responses of the requests sent with an Idempotency-Key
+idempotency = IdempotencyStore(app)
+
 ######################################################################
 # Error Handlers
 ######################################################################
@@ -36,6 +90,12 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(RateLimitExceeded)
+def request_rate_limit_error(error):
+    """ Handles requests rejected by the rate limiter """
+    return too_many_requests(error)
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
@@ -124,6 +184,23 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """ Handles rejected requests with 429_TOO_MANY_REQUESTS """
+    message = str(error)
+    app.logger.warning(message)
+    retry_after = getattr(error, "retry_after", app.config["CONCURRENCY_RETRY_AFTER"])
+    return (
+        jsonify(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=message,
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        {"Retry-After": str(retry_after)},
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -139,6 +216,62 @@ def internal_server_error(error):
     )
 
 
+######################################################################
+# Request Correlation
+######################################################################
+@app.before_request
+def assign_request_id():
+    """ Gives every request an id that its log lines and response carry """
+    request.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+
+
+@app.after_request
+def return_request_id(response):
+    """ Returns the id of the request to the client """
+    response.headers["X-Request-ID"] = getattr(request, "request_id", "")
+    return response
+
+
+######################################################################
+# Read Replica Routing
+######################################################################
+@app.before_request
+def route_reads():
+    """ Reads from a replica on GET unless the client wrote recently """
+    if request.method in ("GET", "HEAD"):
+        db.router.read_from_replica(not db.router.is_sticky(limiter.client_key()))
+
+
+# POSTed for the size of their body, they write nothing
+READ_ONLY_ENDPOINTS = {"batch_get_pats"}
+
+
+@app.after_request
+def track_writes(response):
+    """ Keeps the reads of a client that just wrote on the primary """
+    wrote = request.method in ("POST", "PUT", "DELETE") and request.endpoint not in READ_ONLY_ENDPOINTS
+    if wrote and response.status_code < 400:
+        db.router.mark_write(limiter.client_key(), response)
+    return response
+
+
+@app.teardown_request
+def release_session(exception=None):
+    """ Ends the session of a request so that the next one can use another engine """
+    db.session.remove()
+    if Pat.shards is not None:
+        Pat.shards.remove()
+
+
+######################################################################
+# Response Compression
+######################################################################
+@app.after_request
+def compress(response):
+    """ Compresses responses with the encoding negotiated with the client """
+    return compress_response(response)
+
+
 ######################################################################
 # GET INDEX PAGE
 ######################################################################
@@ -159,39 +292,63 @@ def index():
 # LIST ALL PATIENTS - GET
 ######################################################################
 @app.route("/pats", methods=["GET"])
+@limiter.limit("expensive")
 def list_pats():
     """ Returns all of the Pats """
     app.logger.info("Request for patient list")
-    pats = []
-    
+    fields = Pat.parse_fields(request.args.get("fields"))
+    include_archived = parse_include_archived()
+    ids = request.args.get("ids")
+    if ids is not None:
+        results = coalesce("batch", lambda: batch_lookup(ids.split(","), fields, include_archived))
+        return make_response(jsonify(results), status.HTTP_200_OK)
+    if any(name in request.args for name in ("dob_from", "dob_to", "age_min", "age_max")):
+        return list_pats_by_dob(fields, include_archived)
+
     fname = request.args.get("fname")
     lname = request.args.get("lname")
     phone_home = request.args.get("phone_home")
     postal_code = request.args.get("postal_code")
+    state = request.args.get("state")
     sex = request.args.get("sex")
+    if include_archived and not (fname or lname or phone_home or postal_code):
+        # the archive only grows, it is never listed whole
+        raise DataValidationError(
+            "include_archived needs ids, a DOB range or a fname, lname, phone_home or postal_code filter"
+        )
 
     
-    if fname:
-        pats = Pat.find_by_fname(fname)
-    elif lname:
-        pats = Pat.find_by_lname(lname)
-    elif phone_home:
-        pats = Pat.find_by_phone(phone_home)
-    elif postal_code: 
-        pats = Pat.find_by_zip(postal_code)
-    elif sex:
-        pats = Pat.find_by_gender(getattr(Gender, sex))
-    else:
-        pats = Pat.all()
-
-    results = [pat.serialize() for pat in pats]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    if fields is None and Pat.documents and accepted_mimetype() != COLUMNAR_JSON:
+        filters = [("fname", fname), ("lname", lname), ("phone_home", phone_home),
+                   ("postal_code", postal_code), ("state", state), ("gender", sex and getattr(Gender, sex))]
+        column, value = next(((column, value) for column, value in filters if value), (None, None))
+        return render_documents(coalesce("documents", lambda: Pat.find_documents(column, value, include_archived)))
+
+    def load():
+        if fname:
+            pats = Pat.find_by_fname(fname, fields, include_archived)
+        elif lname:
+            pats = Pat.find_by_lname(lname, fields, include_archived)
+        elif phone_home:
+            pats = Pat.find_by_phone(phone_home, fields, include_archived)
+        elif postal_code: 
+            pats = Pat.find_by_zip(postal_code, fields, include_archived)
+        elif state:
+            pats = Pat.find_by_state(state, fields, include_archived)
+        elif sex:
+            pats = Pat.find_by_gender(getattr(Gender, sex), fields, include_archived)
+        else:
+            pats = Pat.all(fields, include_archived)
+        return [pat.serialize(fields) for pat in pats]
+
+    return render_pats(coalesce("records", load), fields)
 
 
 ######################################################################
 # RETRIEVE A PATIENT - GET + ID
 ######################################################################
 @app.route("/pats/<int:pat_id>", methods=["GET"])
+@limiter.limit("cheap")
 def get_pats(pat_id):
     """
     Retrieve a single Pat
@@ -199,16 +356,74 @@ def get_pats(pat_id):
     This endpoint will return a Pat based on his id
     """
     app.logger.info("Request for patient with id: %s", pat_id)
+    fields = Pat.parse_fields(request.args.get("fields"))
+    include_archived = parse_include_archived()
+
+    def load():
+        pat = Pat.find(pat_id, fields, include_archived)
+        return None if pat is None else pat.serialize(fields)
+
+    result = coalesce("record", load)
+    if result is None:
+        raise NotFound("Patient with id '{}' was not found.".format(pat_id))
+    return make_response(jsonify(result), status.HTTP_200_OK)
+
+
+######################################################################
+# RETRIEVE PATIENTS IN BATCH - POST + IDS
+######################################################################
+@app.route("/pats/batch-get", methods=["POST"])
+@limiter.limit("expensive")
+def batch_get_pats():
+    """
+    Retrieve a batch of Pats
+
+    This endpoint will return the Pats for the ids listed in the body,
+    in request order with a not found marker for every missing id
+    """
+    app.logger.info("Request for a batch of patients")
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get("ids"), list):
+        raise DataValidationError("Invalid batch request: body must contain a list of ids")
+    fields = Pat.parse_fields(request.args.get("fields"))
+    return make_response(jsonify(batch_lookup(data["ids"], fields)), status.HTTP_200_OK)
+
+
+######################################################################
+# RETRIEVE THE DUPLICATES OF A PATIENT - GET + ID
+######################################################################
+@app.route("/pats/<int:pat_id>/duplicates", methods=["GET"])
+@limiter.limit("cheap")
+def get_pat_duplicates(pat_id):
+    """
+    Retrieve the likely duplicates of a Pat
+
+    This endpoint will return the Pats sharing the blocking key of a Pat that
+    score at least min_score, each with its score, best match first
+    """
+    app.logger.info("Request for duplicates of patient with id: %s", pat_id)
+    try:
+        min_score = float(request.args.get("min_score", app.config["DUPLICATE_MIN_SCORE"]))
+    except ValueError:
+        raise DataValidationError("Invalid min_score: must be a number")
     pat = Pat.find(pat_id)
     if not pat:
         raise NotFound("Patient with id '{}' was not found.".format(pat_id))
-    return make_response(jsonify(pat.serialize()), status.HTTP_200_OK)
+    matches = [(similarity(pat, other), other) for other in Pat.find_duplicates(pat)]
+    results = [
+        {"score": score, "patient": other.serialize()}
+        for score, other in sorted(matches, key=lambda match: (-match[0], match[1].id))
+        if score >= min_score
+    ]
+    return make_response(jsonify(results), status.HTTP_200_OK)
 
 
 ######################################################################
 # ADD A NEW PATIENT - POST
 ######################################################################
 @app.route("/pats", methods=["POST"])
+@limiter.limit("cheap")
 def create_pats():
     """
     Creates a Pat
@@ -216,6 +431,32 @@ def create_pats():
     """
     app.logger.info("Request to create a patient")
     check_content_type("application/json")
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return create_pat()
+    key = idempotency.scoped(limiter.client_key(), key)
+
+    # Retries with the same key get the stored response back
+    with idempotency.lock(key):
+        fingerprint = idempotency.fingerprint(request.method, request.path, request.get_data())
+        stored = idempotency.begin(key, fingerprint)
+        if stored is not None:
+            app.logger.info("Replaying the response for Idempotency-Key %s", key)
+            headers = {"Content-Type": "application/json", "Idempotent-Replayed": "true"}
+            if stored.location:
+                headers["Location"] = stored.location
+            return make_response(stored.body, stored.status_code, headers)
+        try:
+            response = create_pat()
+        except Exception:
+            idempotency.abandon(key)
+            raise
+        idempotency.complete(key, response)
+        return response
+
+
+def create_pat():
+    """ Creates a Pat from the posted data and returns the 201 response """
     pat = Pat()
     pat.deserialize(request.get_json())
     pat.create()
@@ -230,6 +471,7 @@ def create_pats():
 # UPDATE AN EXISTING PATIENT - PUT + ID
 ######################################################################
 @app.route("/pats/<int:pat_id>", methods=["PUT"])
+@limiter.limit("cheap")
 def update_pats(pat_id):
     """
     Update a Pat
@@ -251,11 +493,13 @@ def update_pats(pat_id):
 # DELETE A PATIENT - DELETE + ID
 ######################################################################
 @app.route("/pats/<int:pat_id>", methods=["DELETE"])
+@limiter.limit("cheap")
 def delete_pats(pat_id):
     """
     Delete a Pat
 
-    This endpoint will delete a Pat based the id specified in the path
+    This endpoint will delete a Pat based the id specified in the path,
+    the record is kept and archived later
     """
     app.logger.info("Request to delete the patient with id: %s", pat_id)
     pat = Pat.find(pat_id)
@@ -264,17 +508,300 @@ def delete_pats(pat_id):
     return make_response("", status.HTTP_204_NO_CONTENT)
 
 
+######################################################################
+# PROFILED SQL QUERIES - GET
+######################################################################
+@app.route("/debug/queries", methods=["GET"])
+def list_profiled_queries():
+    """ Returns the SQL statements of the last profiled requests """
+    if not app.config["SQL_PROFILE_DEBUG_ENDPOINT"]:
+        raise NotFound("SQL profiling history is not enabled.")
+    return make_response(jsonify(list(profiler.history)), status.HTTP_200_OK)
+
+
+######################################################################
+# COMPILED STATEMENT CACHE - GET
+######################################################################
+@app.route("/debug/statement-cache", methods=["GET"])
+def get_statement_cache():
+    """ Returns how full the cache of compiled finder statements is """
+    if not app.config["STATEMENT_CACHE_DEBUG_ENDPOINT"]:
+        raise NotFound("Statement cache statistics are not enabled.")
+    return make_response(jsonify(Pat.statements.stats()), status.HTTP_200_OK)
+
+
+######################################################################
+# COALESCED READS - GET
+######################################################################
+@app.route("/debug/single-flight", methods=["GET"])
+def get_single_flight():
+    """ Returns how many reads ran and how many shared the result of an identical one """
+    if not app.config["SINGLE_FLIGHT_DEBUG_ENDPOINT"]:
+        raise NotFound("Single-flight statistics are not enabled.")
+    return make_response(jsonify(single_flight.stats()), status.HTTP_200_OK)
+
+
 ######################################################################
 #  UTILITY FUNCTIONS
 ######################################################################
 
 
+@app.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys():
+    """ Deletes the expired idempotency keys """
+    count = idempotency.purge_expired()
+    app.logger.info("Purged %d expired idempotency keys", count)
+
+
+@app.cli.command("find-duplicates")
+@click.option("--min-score", type=float, default=None, help="The lowest similarity reported.")
+def find_duplicates(min_score):
+    """ Writes the likely duplicate patients as CSV lines: id,other_id,score """
+    if min_score is None:
+        min_score = app.config["DUPLICATE_MIN_SCORE"]
+    pairs = candidate_pairs(Pat.blocks(), min_score, app.config["DUPLICATE_MAX_BLOCK_SIZE"])
+    count = 0
+    for pat, other, score in pairs:
+        click.echo("{},{},{}".format(pat.id, other.id, score))
+        count += 1
+    app.logger.info("Found %d candidate duplicate pairs", count)
+
+
+@app.cli.command("load-pats")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--workers", type=int, default=None, help="Worker processes, LOADER_WORKERS by default.")
+@click.option("--chunk-size", type=int, default=None, help="Rows per chunk, LOADER_CHUNK_SIZE by default.")
+@click.option("--copy/--no-copy", "use_copy", default=True, help="Use COPY on PostgreSQL.")
+@click.option("--rejects", type=click.File("a"), default=None, help="CSV file the rejected rows are appended to.")
+def load_pats(paths, workers, chunk_size, use_copy, rejects):
+    """ Loads patients from CSV files, resuming after the chunks already loaded """
+    if Pat.shards is not None:
+        raise click.ClickException("Load each shard database separately, sharded loads are not supported.")
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if uri == "sqlite://" or ":memory:" in uri:
+        raise click.ClickException("An in-memory database cannot be shared with the loader processes.")
+    try:
+        stats = loader.load(
+            uri, list(paths),
+            workers=workers or app.config["LOADER_WORKERS"],
+            chunk_size=chunk_size or app.config["LOADER_CHUNK_SIZE"],
+            use_copy=use_copy,
+            rejects=rejects,
+            report=lambda stats: click.echo(str(stats), err=True),
+        )
+    except loader.LoadError as error:
+        raise click.ClickException(str(error))
+    click.echo(str(stats))
+
+
+@app.cli.command("archive-pats")
+@click.option("--older-than-days", type=float, default=None, help="Days since deletion, ARCHIVE_AFTER_DAYS by default.")
+@click.option("--batch-size", type=int, default=None, help="Rows per batch, ARCHIVE_BATCH_SIZE by default.")
+@click.option("--sleep", type=float, default=None, help="Seconds between batches, ARCHIVE_SLEEP_SECONDS by default.")
+@click.option("--max-batches", type=int, default=None, help="Stop after this many batches.")
+def archive_pats(older_than_days, batch_size, sleep, max_batches):
+    """ Moves the patients deleted long enough ago to the archive table """
+    count = archive.run(
+        app.config["ARCHIVE_AFTER_DAYS"] if older_than_days is None else older_than_days,
+        batch_size=batch_size or app.config["ARCHIVE_BATCH_SIZE"],
+        sleep=app.config["ARCHIVE_SLEEP_SECONDS"] if sleep is None else sleep,
+        max_lag=app.config["ARCHIVE_MAX_REPLICA_LAG"],
+        max_batches=max_batches,
+        report=lambda shard, total: click.echo("shard {}: {} archived".format(shard, total), err=True),
+    )
+    click.echo("Archived {} patients".format(count))
+
+
+backfill_cli = AppGroup("backfill", help="Fills new Pat columns on the rows written before them.")
+app.cli.add_command(backfill_cli)
+
+
+@backfill_cli.command("run")
+@click.argument("name", type=click.Choice(sorted(backfill.BACKFILLS)))
+@click.option("--batch-size", type=int, default=None, help="Rows per batch, BACKFILL_BATCH_SIZE by default.")
+@click.option("--sleep", type=float, default=None, help="Seconds between batches, BACKFILL_SLEEP_SECONDS by default.")
+@click.option("--max-batches", type=int, default=None, help="Stop after this many batches.")
+def run_backfill(name, batch_size, sleep, max_batches):
+    """ Runs a backfill, or resumes it where it stopped """
+    done = backfill.run(
+        name,
+        batch_size=batch_size or app.config["BACKFILL_BATCH_SIZE"],
+        sleep=app.config["BACKFILL_SLEEP_SECONDS"] if sleep is None else sleep,
+        max_lag=app.config["BACKFILL_MAX_REPLICA_LAG"],
+        max_batches=max_batches,
+        report=lambda job: click.echo(
+            "{} shard {}: {} rows, up to id {}".format(job.name, job.shard, job.rows, job.last_id), err=True
+        ),
+    )
+    click.echo("{} {}".format(name, "done" if done else "stopped"))
+
+
+@backfill_cli.command("pause")
+@click.argument("name", type=click.Choice(sorted(backfill.BACKFILLS)))
+def pause_backfill(name):
+    """ Pauses a running backfill after its current batch """
+    click.echo("Paused {} jobs".format(backfill.pause(name)))
+
+
+@backfill_cli.command("status")
+def backfill_status():
+    """ Lists the backfill jobs and their progress """
+    for job in backfill.jobs():
+        click.echo("{} shard {}: {}, {} rows, up to id {}, updated {:%Y-%m-%d %H:%M:%S}".format(
+            job.name, job.shard, job.status, job.rows, job.last_id, job.updated_at))
+
+
 def init_db():
     """ Initialies the SQLAlchemy app """
     global app
     Pat.init_db(app)
 
 
+def batch_lookup(ids, fields=None, include_archived=False):
+    """ Looks up a batch of Pats and returns them serialized in request order """
+    try:
+        pat_ids = [int(pat_id) for pat_id in ids]
+    except (TypeError, ValueError):
+        raise DataValidationError("Invalid batch request: ids must be integers")
+    if len(pat_ids) > app.config["BATCH_GET_MAX_IDS"]:
+        raise DataValidationError(
+            "Invalid batch request: at most {} ids are allowed".format(app.config["BATCH_GET_MAX_IDS"])
+        )
+    found = Pat.find_many(
+        pat_ids, chunk_size=app.config["BATCH_GET_CHUNK_SIZE"], fields=fields, include_archived=include_archived
+    )
+    return [
+        found[pat_id].serialize(fields) if pat_id in found
+        else {"id": pat_id, "status": status.HTTP_404_NOT_FOUND, "error": "Not Found"}
+        for pat_id in pat_ids
+    ]
+
+
+def list_pats_by_dob(fields=None, include_archived=False):
+    """ Returns a page of the Pats born in the requested DOB range or age band """
+    dob_from = parse_arg("dob_from", parse_date)
+    dob_to = parse_arg("dob_to", parse_date)
+    age_min = parse_arg("age_min", int)
+    age_max = parse_arg("age_max", int)
+    if not 0 <= (age_min or 0) <= (MAX_AGE if age_max is None else age_max) <= MAX_AGE:
+        raise DataValidationError(
+            "Invalid age band: ages must be between 0 and {} and age_min no more than age_max".format(MAX_AGE)
+        )
+    age_from, age_to = Pat.dob_bounds(age_min, age_max)
+    # an age band and a DOB range can be combined, the narrower bound wins
+    dob_from = max((bound for bound in (dob_from, age_from) if bound is not None), default=None)
+    dob_to = min((bound for bound in (dob_to, age_to) if bound is not None), default=None)
+    limit = parse_arg("limit", int)
+    if limit is None:
+        limit = app.config["PAGE_SIZE"]
+    if not 0 < limit <= app.config["PAGE_SIZE_MAX"]:
+        raise DataValidationError("Invalid limit: must be between 1 and {}".format(app.config["PAGE_SIZE_MAX"]))
+    after = parse_arg("after", parse_cursor)
+
+    def load():
+        pats = Pat.find_by_dob_range(dob_from, dob_to, limit, after, fields, include_archived)
+        # the keyset of the next page, when there may be one
+        cursor = None
+        if len(pats) == limit:
+            cursor = "{},{}".format(pats[-1].DOB.strftime("%Y-%m-%d"), pats[-1].id)
+        return [pat.serialize(fields) for pat in pats], cursor
+
+    results, cursor = coalesce("page", load)
+    response = render_pats(results, fields)
+    if cursor is not None:
+        args = request.args.to_dict()
+        args["after"] = cursor
+        response.headers["Link"] = '<{}>; rel="next"'.format(url_for("list_pats", _external=True, **args))
+    return response
+
+
+def parse_arg(name, parse):
+    """ Parses a query parameter, None when it is missing """
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return parse(value)
+    except ValueError:
+        raise DataValidationError("Invalid {}: {}".format(name, value))
+
+
+def parse_include_archived():
+    """ Parses the include_archived flag, which needs the ARCHIVE_AUDIT_TOKEN """
+    if not parse_arg("include_archived", parse_bool):
+        return False
+    token = app.config["ARCHIVE_AUDIT_TOKEN"]
+    sent = request.headers.get(app.config["ARCHIVE_AUDIT_HEADER"])
+    if not (token and sent and hmac.compare_digest(sent.encode("utf-8"), token.encode("utf-8"))):
+        abort(status.HTTP_403_FORBIDDEN, "Deleted and archived patients are only returned for audits.")
+    return True
+
+
+def parse_date(value):
+    """ Parses a YYYY-MM-DD date """
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def parse_bool(value):
+    """ Parses a true or false flag """
+    if value.lower() not in ("true", "false"):
+        raise ValueError(value)
+    return value.lower() == "true"
+
+
+def parse_cursor(value):
+    """ Parses the DOB,id keyset a page resumes after """
+    dob, pat_id = value.split(",")
+    return parse_date(dob), int(pat_id)
+
+
+def accepted_mimetype():
+    """ Returns the representation of a patient list the client accepts """
+    return request.accept_mimetypes.best_match([JSON, NDJSON, COLUMNAR_JSON]) or JSON
+
+
+def render_documents(docs):
+    """ Renders stored JSON documents as a JSON or NDJSON list without decoding them """
+    if accepted_mimetype() == NDJSON:
+        return Response("".join(doc + "\n" for doc in docs), status.HTTP_200_OK, mimetype=NDJSON)
+    return Response("[" + ",".join(docs) + "]", status.HTTP_200_OK, mimetype=JSON)
+
+
+def coalesce(kind, load):
+    """ Runs the load of a read once for all the identical requests in flight
+
+    Args:
+        kind (string): what load returns, e.g. "records" or "documents"
+        load (function): reads the database, returning plain data
+    """
+    if db.router.is_sticky(limiter.client_key()) or QueryProfiler.current_profile() is not None:
+        return load()
+    key = (
+        kind, request.endpoint,
+        tuple(sorted(request.view_args.items())), tuple(sorted(request.args.items(multi=True))),
+    )
+    return single_flight.do(key, load)
+
+
+def render_pats(results, fields=None):
+    """ Renders a list of serialized Pats in the representation the client accepts """
+    mimetype = accepted_mimetype()
+    if mimetype == NDJSON:
+        def generate():
+            for result in results:
+                yield json.dumps(result, separators=(",", ":")) + "\n"
+        return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=NDJSON)
+
+    if mimetype == COLUMNAR_JSON:
+        # the union of the keys, as only the deleted Pats have a deleted_at
+        columns = fields or list(dict.fromkeys(column for result in results for column in result))
+        rows = [[result.get(column) for column in columns] for result in results]
+        return make_response(
+            jsonify(columns=columns, rows=rows), status.HTTP_200_OK, {"Content-Type": COLUMNAR_JSON}
+        )
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers["Content-Type"] == content_type:
@@ -0,0 +1,187 @@
+# License info goes here.
+
+"""
+Horizontal Sharding of the Patients
+
+Spreads the pat table over several databases listed in SQLALCHEMY_SHARD_URIS.
+Every patient gets a 64 bit id from IdGenerator that records the shard it
+lives on, so lookups by id go straight to one shard. New patients are placed
+by SHARD_STRATEGY:
+
+id - the shards take turns, which spreads the patients evenly
+state - each state lives on one shard (SHARD_STATES, or a hash of the state)
+
+Queries that cannot be routed to a single shard run on all of them in
+parallel and their results are merged in id order.
+
+Id layout
+---------
+41 bits - milliseconds since ID_EPOCH
+ 8 bits - shard number
+ 5 bits - worker number, unique per process generating ids (ID_WORKER)
+ 9 bits - sequence within the millisecond
+"""
+import time
+import heapq
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
+
+# 2020-01-01T00:00:00Z in milliseconds
+ID_EPOCH = 1577836800000
+SHARD_BITS = 8
+WORKER_BITS = 5
+SEQUENCE_BITS = 9
+MAX_SHARDS = 1 << SHARD_BITS
+
+
+class IdGenerator:
+    """ Generates time ordered ids that are unique across shards and workers """
+
+    def __init__(self, worker):
+        if not 0 <= worker < 1 << WORKER_BITS:
+            raise ValueError("The worker number must be between 0 and {}".format((1 << WORKER_BITS) - 1))
+        self.worker = worker
+        self._last = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self, shard):
+        """ Returns a new id for a row stored on the given shard """
+        with self._lock:
+            now = max(int(time.time() * 1000), self._last)
+            if now == self._last:
+                self._sequence = (self._sequence + 1) % (1 << SEQUENCE_BITS)
+                if self._sequence == 0:
+                    # the sequence is used up, wait for the next millisecond
+                    while now <= self._last:
+                        now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+            self._last = now
+            return ((now - ID_EPOCH) << (SHARD_BITS + WORKER_BITS + SEQUENCE_BITS)) \
+                | (shard << (WORKER_BITS + SEQUENCE_BITS)) \
+                | (self.worker << SEQUENCE_BITS) \
+                | self._sequence
+
+    @staticmethod
+    def shard_of(row_id):
+        """ Returns the shard recorded in an id """
+        return (row_id >> (WORKER_BITS + SEQUENCE_BITS)) % MAX_SHARDS
+
+
+class ShardSet:
+    """ The databases holding the shards and the sessions used on them """
+
+    def __init__(self, uris, worker, strategy="id", states=None):
+        if not 0 < len(uris) <= MAX_SHARDS:
+            raise ValueError("Between 1 and {} shards are supported".format(MAX_SHARDS))
+        if strategy not in ("id", "state"):
+            raise ValueError("Unknown shard strategy: " + strategy)
+        if worker is None:
+            # a number derived from the pid is not unique across processes and hosts
+            raise ValueError("Set ID_WORKER to a number unique to every process generating ids")
+        self.strategy = strategy
+        self.states = dict(states or {})
+        self.engines = [create_engine(uri) for uri in uris]
+        self.sessions = [scoped_session(sessionmaker(bind=engine)) for engine in self.engines]
+        self.worker = worker
+        self.ids = IdGenerator(worker)
+        self._turn = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.engines))
+
+    @classmethod
+    def from_app(cls, app):
+        """ Creates the shards configured for an app, or returns None without any """
+        uris = app.config.get("SQLALCHEMY_SHARD_URIS")
+        if not uris:
+            return None
+        return cls(uris, app.config.get("ID_WORKER"), app.config["SHARD_STRATEGY"], app.config["SHARD_STATES"])
+
+    def create_all(self, tables):
+        """ Creates the sharded tables on every shard """
+        for engine in self.engines:
+            for table in tables:
+                table.create(engine, checkfirst=True)
+
+    def drop_all(self, tables):
+        """ Drops the sharded tables on every shard """
+        for engine in self.engines:
+            for table in tables:
+                table.drop(engine, checkfirst=True)
+
+    def shard_for_state(self, state):
+        """ Returns the shard that holds the patients of a state """
+        if state in self.states:
+            return self.states[state]
+        return zlib.crc32(state.encode("utf-8")) % len(self.engines)
+
+    def shard_for_new(self, state):
+        """ Returns the shard a new patient is stored on """
+        if self.strategy == "state":
+            return self.shard_for_state(state)
+        with self._lock:
+            self._turn = (self._turn + 1) % len(self.engines)
+            return self._turn
+
+    def shards_for(self, ids=None, state=None):
+        """ Returns the shards that can hold the given ids or state, None for all """
+        if ids is not None:
+            shards = {self.ids.shard_of(row_id) for row_id in ids}
+            return sorted(shard for shard in shards if shard < len(self.engines))
+        if state is not None and self.strategy == "state":
+            return [self.shard_for_state(state)]
+        return None
+
+    def session_for_id(self, row_id):
+        """ Returns the session of the shard that holds an id, None if there is no such shard """
+        shard = self.ids.shard_of(row_id)
+        return self.sessions[shard] if shard < len(self.sessions) else None
+
+    def scatter(self, build_query, shards=None, key=None):
+        """
+        Runs a query on several shards in parallel and merges the rows by id
+
+        Args:
+            build_query (function): builds the query to run from a session
+            shards (list): the shard numbers to query, all of them if None
+            key (function): the sort key of the rows when they are not ordered by id
+        """
+        if shards is None:
+            shards = range(len(self.engines))
+        futures = [self._executor.submit(self._run, build_query, shard) for shard in shards]
+        return list(heapq.merge(*[future.result() for future in futures], key=key or (lambda row: row.id)))
+
+    def _run(self, build_query, shard):
+        """ Runs a query on one shard with a session of its own """
+        session = Session(bind=self.engines[shard], expire_on_commit=False)
+        try:
+            return build_query(session).all()
+        finally:
+            session.close()
+
+    def remove(self):
+        """ Ends the sessions of the current thread """
+        for session in self.sessions:
+            session.remove()
+
+    def dispose(self):
+        """ Closes the connections of every shard """
+        for engine in self.engines:
+            engine.dispose()
+
+    def after_fork(self, worker=None):
+        """ Replaces what a forked worker inherited and must not share
+
+        The pooled connections are dropped, the query threads did not survive
+        the fork, and the ids are generated with the worker number of the child
+        (kept when None), as its parent's would collide with its siblings'
+        """
+        self.dispose()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.engines))
+        if worker is not None:
+            self.worker = worker
+        self.ids = IdGenerator(self.worker)
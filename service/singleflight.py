@@ -0,0 +1,96 @@
+# License info goes here.
+
+"""
+Request Coalescing
+
+During a surge many clients send the same read at the same moment. A
+SingleFlight runs the first one and makes the identical reads that arrive
+while it is still in flight wait for it and share its result, so the
+database serves one query instead of one per request. It works across the
+threads of a worker process (threaded or gthread workers); each process
+coalesces its own requests.
+
+Only plain data is shared (serialized patients, stored documents, ...), the
+Pats of a request's session never cross threads. A shared read can miss a
+write committed while its query runs, as if it had started a moment
+earlier, so the reads of clients that just wrote and the profiled requests
+are not coalesced.
+"""
+import logging
+import threading
+
+logger = logging.getLogger("service.singleflight")
+
+
+class Call:
+    """ A call in flight, the result or error its waiters share """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """ Folds identical concurrent calls into one """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Reads the settings of the app and resets the counters """
+        self.app = app
+        with self._lock:
+            self.calls = 0
+            self.coalesced = 0
+
+    @property
+    def enabled(self):
+        return self.app is None or self.app.config["SINGLE_FLIGHT_ENABLED"]
+
+    def do(self, key, load):
+        """ Returns the result of load(), shared with the calls of the same key in flight
+
+        Args:
+            key (tuple): identifies the calls that return the same result
+            load (function): computes the result, must return plain data
+        """
+        if not self.enabled:
+            return load()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self.calls += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = load()
+            except Exception as error:  # handed to the waiters as well
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            if call.waiters:
+                logger.debug("Coalesced %d calls into %s", call.waiters, key)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        """ Returns the calls run, the calls that shared the result of another and those in flight """
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._calls)}
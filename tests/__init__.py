@@ -1 +1,47 @@
 # License info goes here.
+
+"""
+Test package set up
+
+The tests run on an in-memory SQLite database unless DATABASE_URI names
+another one, so that the suite is fast and works offline. When the suite is
+split over parallel processes (pytest -n with pytest-xdist, or TEST_WORKER
+set by another runner) every worker gets a database of its own: in-memory
+databases are private to a process already, the others get the worker name
+appended to the database name.
+
+This runs before the service package is imported, which connects to the
+database configured in the environment.
+"""
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+
+def worker_database_uri(uri, worker):
+    """ Returns the database of a test worker, creating it on PostgreSQL """
+    url = make_url(uri)
+    if not worker or not url.database or url.database == ":memory:":
+        return uri
+    if url.drivername.startswith("sqlite"):
+        root, ext = os.path.splitext(url.database)
+        url.database = "{}_{}{}".format(root, worker, ext)
+        return str(url)
+    database = "{}_{}".format(url.database, worker)
+    if url.drivername.startswith("postgres"):
+        engine = create_engine(uri, isolation_level="AUTOCOMMIT")
+        with engine.connect() as connection:
+            exists = connection.execute("SELECT 1 FROM pg_database WHERE datname = %s", database).scalar()
+            if not exists:
+                connection.execute('CREATE DATABASE "{}"'.format(database))
+        engine.dispose()
+    url.database = database
+    return str(url)
+
+
+os.environ["DATABASE_URI"] = worker_database_uri(
+    os.getenv("DATABASE_URI", "sqlite://"),
+    os.getenv("PYTEST_XDIST_WORKER") or os.getenv("TEST_WORKER"),
+)
+# do not look up the mail servers of the sample email addresses
+os.environ.setdefault("EMAIL_CHECK_DELIVERABILITY", "false")
@@ -3,9 +3,10 @@
 """
 Test Factory to make fake objects for testing
 """
+from datetime import datetime
 import factory
 from factory.fuzzy import FuzzyChoice
-from service.models import Pat, Gender
+from service.models import Pat, Gender, db
 
 class PatFactory(factory.Factory):
     """ Creates fake personal info that you don't have to feed from sample data """
@@ -13,13 +14,36 @@ class PatFactory(factory.Factory):
     class Meta:
         model = Pat
 
-    id = factory.Sequence(lambda n: n)
+    class Params:
+        birth_date = factory.Faker("date_of_birth", minimum_age=0, maximum_age=100)
+
+    title = factory.Faker("prefix")
     fname = factory.Faker("first_name")
+    mname = factory.Faker("first_name")
     lname = factory.Faker("last_name")
-    phone_home = factory.Faker("phone_number")
-    email = factory.Faker("email")
+    street = factory.Faker("street_address")
+    postal_code = factory.Faker("postcode")
     city = factory.Faker("city")
-    state = factory.Faker("state")
+    state = factory.Faker("state_abbr")
+    phone_home = factory.Faker("numerify", text="(###) ###-####")
+    email = factory.Faker("email")
+    DOB = factory.LazyAttribute(lambda pat: datetime.combine(pat.birth_date, datetime.min.time()))
     #resourceType = FuzzyChoice(choices=["Patient", "Nurse", "Doctor", "Staff"])
-    available = FuzzyChoice(choices=[True, False])
     gender = FuzzyChoice(choices=[Gender.Male, Gender.Female, Gender.Unknown])
+
+    @classmethod
+    def _create(cls, model_class, *args, **kwargs):
+        """ Saves a fake patient with Pat.create() """
+        pat = model_class(*args, **kwargs)
+        pat.create()
+        return pat
+
+    @classmethod
+    def create_bulk(cls, size, **kwargs):
+        """ Saves a batch of fake patients in a single transaction """
+        pats = cls.build_batch(size, **kwargs)
+        for pat in pats:
+            pat.update_derived_columns()
+        db.session.add_all(pats)
+        db.session.commit()
+        return pats
@@ -0,0 +1,94 @@
+# License info goes here.
+
+"""
+Database fixtures for the tests
+
+DatabaseTestCase runs every test inside a transaction on one connection
+and rolls it back afterwards, instead of dropping and creating the tables.
+The code under test gets a session bound to that connection that works in a
+SAVEPOINT, so its commits and rollbacks behave as usual without ever ending
+the test's transaction.
+
+Ids drawn from a PostgreSQL sequence are not rolled back, so on databases
+other than SQLite the tables are recreated around each test as before.
+"""
+import unittest
+from flask import _app_ctx_stack
+from sqlalchemy import event, orm
+from service.models import db
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """ Test case that rolls back the changes of every test """
+
+    def setUp(self):
+        if db.engine.dialect.name != "sqlite":
+            self.connection = None
+            db.drop_all()  # clean up the last tests
+            db.create_all()  # make our sqlalchemy tables
+            return
+        begin_sqlite_transactions(db.engine)
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        self.sessions = []
+        factory = db.create_session({"bind": self.connection, "binds": {}})
+        db.session = orm.scoped_session(
+            lambda: self.begin_savepoint(factory()), scopefunc=_app_ctx_stack.__ident_func__
+        )
+
+    def tearDown(self):
+        if self.connection is None:
+            db.session.remove()
+            db.drop_all()
+            return
+        for session in self.sessions:
+            session.close()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+
+    def begin_savepoint(self, session):
+        """ Starts a session in a SAVEPOINT that is renewed when it ends """
+        session.begin_nested()
+        event.listen(session, "after_transaction_end", restart_savepoint)
+        close = session.close
+
+        def close_savepoint():
+            # roll back the SAVEPOINT as closing a session rolls back, without
+            # starting another one that would be left open on the connection
+            if event.contains(session, "after_transaction_end", restart_savepoint):
+                event.remove(session, "after_transaction_end", restart_savepoint)
+            while session.transaction is not None and session.transaction.nested:
+                session.transaction.rollback()
+            close()
+
+        session.close = close_savepoint
+        self.sessions.append(session)
+        return session
+
+
+def restart_savepoint(session, transaction):
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+def begin_sqlite_transactions(engine):
+    """ Makes pysqlite begin transactions when SQLAlchemy does
+
+    pysqlite defers BEGIN until the first write and commits before DDL, which
+    breaks the SAVEPOINTs the tests roll back to. The connections are changed
+    as they are checked out, as an in-memory database keeps its connection
+    """
+    if not event.contains(engine, "checkout", _disable_pysqlite_transactions):
+        event.listen(engine, "checkout", _disable_pysqlite_transactions)
+        event.listen(engine, "begin", _begin_sqlite_transaction)
+
+
+def _disable_pysqlite_transactions(dbapi_connection, connection_record, connection_proxy):
+    dbapi_connection.isolation_level = None
+
+
+def _begin_sqlite_transaction(connection):
+    connection.execute("BEGIN")
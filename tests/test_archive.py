@@ -0,0 +1,82 @@
+# License info goes here.
+
+"""
+Test cases for the soft delete and the archival of deleted patients
+
+Test cases can be run with:
+    nosetests tests/test_archive.py
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+from service.models import Pat, ArchivedPat, db
+from service import app, archive
+from .factories import PatFactory
+from .fixtures import DatabaseTestCase
+
+DATABASE_URI = os.getenv("DATABASE_URI", "sqlite://")
+
+
+######################################################################
+#  ARCHIVE TEST CASES
+######################################################################
+class TestArchive(DatabaseTestCase):
+    """ Test Cases for deleting and archiving patients """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Pat.init_db(app)
+
+    def setUp(self):
+        super().setUp()
+        self.pats = PatFactory.create_bulk(5, lname="Cohen")
+        self.ids = [pat.id for pat in self.pats]
+
+    def delete(self, index, days_ago):
+        """ Deletes a Pat some days ago """
+        pat = self.pats[index]
+        pat.delete()
+        pat.deleted_at = datetime.utcnow() - timedelta(days=days_ago)
+        pat.save()
+
+    def test_soft_delete(self):
+        """ Skip the deleted Pats unless archived ones are included """
+        self.delete(1, days_ago=0)
+        active = [self.ids[0]] + self.ids[2:]
+        self.assertEqual([pat.id for pat in Pat.all()], active)
+        self.assertEqual([pat.id for pat in Pat.find_by_lname("Cohen")], active)
+        self.assertEqual([pat.id for pat in Pat.find_by_lname("Cohen", include_archived=True)], self.ids)
+        self.assertEqual(sorted(Pat.find_many(self.ids)), active)
+        self.assertIsNone(Pat.find(self.ids[1]))
+        self.assertIsNone(Pat.find(self.ids[1], fields=["id", "lname"]))
+        self.assertEqual(Pat.find(self.ids[1], include_archived=True).id, self.ids[1])
+        self.assertEqual(len(Pat.find_by_dob_range(datetime(1900, 1, 1))), 4)
+        self.assertEqual(len(Pat.find_by_dob_range(datetime(1900, 1, 1), include_archived=True)), 5)
+
+    def test_archive(self):
+        """ Move the Pats deleted long ago to the archive in batches """
+        self.delete(0, days_ago=100)
+        self.delete(2, days_ago=200)
+        self.delete(4, days_ago=300)
+        self.delete(3, days_ago=1)
+        reports = []
+        count = archive.run(30, batch_size=2, sleep=0, report=lambda shard, total: reports.append(total))
+        self.assertEqual((count, reports), (3, [2, 3]))
+        db.session.expunge_all()
+        self.assertEqual([pat.id for pat in Pat.query.order_by(Pat.id)], self.ids[1:2] + self.ids[3:4])
+        archived = ArchivedPat.query.order_by(ArchivedPat.id).all()
+        self.assertEqual([pat.id for pat in archived], [self.ids[0], self.ids[2], self.ids[4]])
+        self.assertEqual(archived[0].serialize()["lname"], "Cohen")
+        self.assertIsNotNone(archived[0].archived_at)
+        # the finders read the archive when asked to
+        self.assertEqual([pat.id for pat in Pat.find_by_lname("Cohen")], [self.ids[1]])
+        self.assertEqual([pat.id for pat in Pat.find_by_lname("Cohen", include_archived=True)], self.ids)
+        found = Pat.find(self.ids[2], include_archived=True)
+        self.assertIsInstance(found, ArchivedPat)
+        self.assertIn("deleted_at", found.serialize())
+        self.assertEqual(sorted(Pat.find_many(self.ids, include_archived=True)), self.ids)
+        # nothing is left to archive
+        self.assertEqual(archive.run(30, sleep=0), 0)
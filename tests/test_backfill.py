@@ -0,0 +1,124 @@
+# License info goes here.
+
+"""
+Test cases for the online schema changes and backfills
+
+Test cases can be run with:
+    nosetests tests/test_backfill.py
+"""
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from sqlalchemy import MetaData, Table, create_engine, inspect
+from service.models import Pat, BackfillJob, db
+from service.schema import add_missing_columns, add_missing_indexes, add_column, create_index, SchemaError
+from service import app, backfill
+from .factories import PatFactory
+from .fixtures import DatabaseTestCase
+
+DATABASE_URI = os.getenv("DATABASE_URI", "sqlite://")
+
+
+######################################################################
+#  BACKFILL TEST CASES
+######################################################################
+class TestBackfill(DatabaseTestCase):
+    """ Test Cases for filling new columns online """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Pat.init_db(app)
+
+    def setUp(self):
+        super().setUp()
+        self.pats = PatFactory.create_bulk(5)
+        # rows written before the columns existed
+        db.session.execute(Pat.__table__.update().values(block_key=None, phone_normalized=None))
+        db.session.commit()
+
+    def column(self, name):
+        return [getattr(pat, name) for pat in Pat.query.order_by(Pat.id)]
+
+    def test_run(self):
+        """ Fill a column in batches without overwriting new writes """
+        pat = Pat.find(self.pats[2].id)
+        pat.phone_home = "(212) 555-0100"
+        pat.save()
+        self.assertTrue(backfill.run("phone_normalized", batch_size=2, sleep=0))
+        expected = ["".join(char for char in pat.phone_home if char.isdigit()) for pat in self.pats]
+        expected[2] = "2125550100"
+        self.assertEqual(self.column("phone_normalized"), expected)
+        job = BackfillJob.query.get(("phone_normalized", 0))
+        self.assertEqual((job.status, job.rows, job.last_id), ("done", 4, self.pats[4].id))
+        # a done backfill has nothing left to do
+        self.assertTrue(backfill.run("phone_normalized", batch_size=2, sleep=0))
+        self.assertIsNone(self.column("block_key")[0])
+
+    def test_pause_and_resume(self):
+        """ Pause a backfill from the outside and resume it where it stopped """
+        done = backfill.run("block_key", batch_size=2, sleep=0, report=lambda job: backfill.pause("block_key"))
+        self.assertFalse(done)
+        job = BackfillJob.query.get(("block_key", 0))
+        self.assertEqual((job.status, job.last_id), ("paused", self.pats[1].id))
+        self.assertEqual(self.column("block_key")[2:], [None, None, None])
+        self.assertFalse(backfill.run("block_key", batch_size=2, sleep=0, max_batches=1))
+        self.assertTrue(backfill.run("block_key", batch_size=2, sleep=0))
+        self.assertNotIn(None, self.column("block_key"))
+        self.assertEqual([job.status for job in backfill.jobs()], ["done"])
+        with self.assertRaises(backfill.BackfillError):
+            backfill.run("category")
+
+
+######################################################################
+#  ONLINE SCHEMA CHANGE TEST CASES
+######################################################################
+class TestSchema(unittest.TestCase):
+    """ Test Cases for adding columns to a table that holds data """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine("sqlite:///" + os.path.join(self.tmpdir, "old.db"))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_missing_columns(self):
+        """ Add the nullable columns and indexes a table lacks """
+        old = [column.copy() for column in Pat.__table__.columns if column.name not in ("block_key", "phone_normalized")]
+        Table("pat", MetaData(), *old).create(self.engine)
+        self.engine.execute("INSERT INTO pat (fname, lname, street, postal_code, city, state, phone_home, \"DOB\", gender) "
+                            "VALUES ('Ann', 'Lee', '1 Main St', '10001', 'New York', 'NY', '(212) 555-0100', "
+                            "'1980-01-01 00:00:00.000000', 'Female')")
+        self.assertEqual(add_missing_columns(self.engine, Pat.__table__), ["block_key", "phone_normalized"])
+        inspector = inspect(self.engine)
+        self.assertIn("phone_normalized", [column["name"] for column in inspector.get_columns("pat")])
+        self.assertEqual(self.engine.execute("SELECT block_key FROM pat").scalar(), None)
+        self.assertEqual(add_missing_columns(self.engine, Pat.__table__), [])
+        self.assertIn("ix_pat_block_key", add_missing_indexes(self.engine, Pat.__table__))
+        self.assertIn("ix_pat_block_key", [index["name"] for index in inspector.get_indexes("pat")])
+        self.assertEqual(add_missing_indexes(self.engine, Pat.__table__), [])
+
+    def test_added_by_another_process(self):
+        """ Skip the columns and indexes another worker added meanwhile """
+        old = [column.copy() for column in Pat.__table__.columns if column.name != "block_key"]
+        Table("pat", MetaData(), *old).create(self.engine)
+        column = Pat.__table__.c.block_key
+        self.assertTrue(add_column(self.engine, Pat.__table__, column))
+        self.assertFalse(add_column(self.engine, Pat.__table__, column))
+        index = next(index for index in Pat.__table__.indexes if index.name == "ix_pat_block_key")
+        create_index(self.engine, index)
+        create_index(self.engine, index)
+        self.assertEqual(add_missing_indexes(self.engine, Pat.__table__).count("ix_pat_block_key"), 0)
+
+    def test_required_column(self):
+        """ Refuse to add a column that needs a value in every row """
+        old = [column.copy() for column in Pat.__table__.columns if column.name != "city"]
+        Table("pat", MetaData(), *old).create(self.engine)
+        with self.assertRaises(SchemaError):
+            add_missing_columns(self.engine, Pat.__table__)
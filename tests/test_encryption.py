@@ -0,0 +1,118 @@
+# License info goes here.
+
+"""
+Test cases for the field level encryption
+
+Test cases can be run with:
+    nosetests tests/test_encryption.py
+"""
+import os
+import base64
+import logging
+from datetime import date
+from service.encryption import EncryptionError, keyring
+from service.models import Pat, db
+from service import app
+from .factories import PatFactory
+from .fixtures import DatabaseTestCase
+
+DATABASE_URI = os.getenv("DATABASE_URI", "sqlite://")
+KEY_A = ("a", base64.b64encode(b"a" * 32).decode("ascii"))
+KEY_B = ("b", base64.b64encode(b"b" * 32).decode("ascii"))
+
+
+######################################################################
+#  FIELD ENCRYPTION TEST CASES
+######################################################################
+class TestEncryption(DatabaseTestCase):
+    """ Test Cases for the encrypted Pat columns """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Pat.init_db(app)
+
+    def setUp(self):
+        super().setUp()
+        keyring.configure([KEY_A])
+
+    def tearDown(self):
+        keyring.configure(app.config["FIELD_ENCRYPTION_KEYS"])
+        super().tearDown()
+
+    def raw(self, pat, column):
+        """ Returns a column of a Pat as stored in the database """
+        return db.session.execute(
+            "SELECT {} FROM pat WHERE id = :id".format(column), {"id": pat.id}
+        ).scalar()
+
+    def test_stored_encrypted(self):
+        """ Store the personal data encrypted and read it back decrypted """
+        pat = PatFactory(lname="Cohen", email="ann@example.com")
+        data = pat.serialize()
+        for column in ("fname", "lname", "street", "phone_home", "email", "block_key"):
+            self.assertTrue(self.raw(pat, column).startswith("enc1:a:"), column)
+        self.assertEqual(self.raw(pat, "postal_code"), pat.postal_code)
+        db.session.expunge_all()
+        found = Pat.find(pat.id)
+        self.assertEqual((found.lname, found.email), ("Cohen", "ann@example.com"))
+        self.assertEqual(found.serialize(), data)
+
+    def test_searchable_columns(self):
+        """ Find Pats by their encrypted names and phone numbers """
+        pats = PatFactory.create_bulk(
+            2, lname="Cohen", email="ann@example.com", birth_date=date(1980, 1, 1), postal_code="10001"
+        )
+        self.assertEqual(self.raw(pats[0], "lname"), self.raw(pats[1], "lname"))
+        # the randomized columns never repeat a ciphertext
+        self.assertNotEqual(self.raw(pats[0], "email"), self.raw(pats[1], "email"))
+        self.assertEqual([pat.id for pat in Pat.find_by_lname("Cohen")], [pat.id for pat in pats])
+        self.assertEqual([pat.id for pat in Pat.find_by_phone(pats[0].phone_home)], [pats[0].id])
+        self.assertEqual([pat.id for pat in Pat.find_duplicates(pats[0])], [pats[1].id])
+
+    def test_key_rotation(self):
+        """ Read the values encrypted with an older key """
+        old = PatFactory(lname="Cohen", birth_date=date(1980, 1, 1), postal_code="10001")
+        keyring.configure([KEY_B, KEY_A])
+        new = PatFactory(lname="Cohen", birth_date=date(1980, 1, 1), postal_code="10001")
+        self.assertTrue(self.raw(new, "lname").startswith("enc1:b:"))
+        old_id, new_id = old.id, new.id
+        db.session.expunge_all()
+        self.assertEqual(Pat.find(old_id).lname, "Cohen")
+        # the values encrypted with the older key are still found
+        self.assertEqual([pat.id for pat in Pat.find_by_lname("Cohen")], [old_id, new_id])
+        self.assertEqual([pat.id for pat in Pat.find_duplicates(Pat.find(new_id))], [old_id])
+        keyring.configure([KEY_B])
+        db.session.expunge_all()
+        with self.assertRaises(EncryptionError):
+            Pat.find(old_id)
+
+    def test_plaintext_rows(self):
+        """ Read the rows written before encryption was turned on """
+        keyring.configure([])
+        pat = PatFactory(lname="Cohen")
+        self.assertEqual(self.raw(pat, "lname"), "Cohen")
+        pat_id, phone = pat.id, pat.phone_home
+        keyring.configure([KEY_A])
+        db.session.expunge_all()
+        self.assertEqual(Pat.find(pat_id).lname, "Cohen")
+        new_id = PatFactory(lname="Cohen").id
+        self.assertEqual([pat.id for pat in Pat.find_by_lname("Cohen")], [pat_id, new_id])
+        self.assertEqual([pat.id for pat in Pat.find_by_phone(phone)], [pat_id])
+
+    def test_context(self):
+        """ Refuse a ciphertext moved to another column """
+        pat_id = PatFactory(fname="Ann", lname="Cohen").id
+        db.session.execute("UPDATE pat SET fname = lname WHERE id = :id", {"id": pat_id})
+        db.session.expunge_all()
+        with self.assertRaises(EncryptionError):
+            Pat.find(pat_id)
+
+    def test_invalid_keys(self):
+        """ Refuse short keys and invalid key ids """
+        with self.assertRaises(EncryptionError):
+            keyring.configure([("short", base64.b64encode(b"k" * 16).decode("ascii"))])
+        with self.assertRaises(EncryptionError):
+            keyring.configure([("a:b", KEY_A[1])])
@@ -0,0 +1,99 @@
+# License info goes here.
+
+"""
+Test cases for the bulk loader
+
+Test cases can be run with:
+    nosetests tests/test_loader.py
+"""
+import io
+import os
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from service.loader import load, read_chunks, LoadError
+
+with open('tests/records.json') as jsonfile:
+    sample_data = json.load(jsonfile)
+
+FIELDS = ["title", "fname", "mname", "lname", "street", "postal_code", "city",
+          "state", "phone_home", "email", "DOB", "sex"]
+
+
+######################################################################
+#  BULK LOADER TEST CASES
+######################################################################
+class TestLoader(unittest.TestCase):
+    """ Test Cases for loading patients from CSV files """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uri = "sqlite:///" + os.path.join(self.tmpdir, "load.db")
+        self.engine = create_engine(self.uri)
+        self.path = os.path.join(self.tmpdir, "pats.csv")
+        with open(self.path, "w", newline="") as csvfile:
+            writer = csv.DictWriter(csvfile, FIELDS)
+            writer.writeheader()
+            for record in sample_data:
+                writer.writerow(record)
+            writer.writerow(dict(sample_data[0], postal_code="123"))
+            writer.writerow(dict(sample_data[1], DOB="1967-13-04"))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def count(self, table):
+        return self.engine.execute("SELECT COUNT(*) FROM {}".format(table)).scalar()
+
+    def test_read_chunks(self):
+        """ Split a file into numbered chunks that know their lines """
+        chunks = list(read_chunks(self.path, 5))
+        self.assertEqual([chunk for chunk, _ in chunks], [0, 1, 2])
+        self.assertEqual([len(rows) for _, rows in chunks], [5, 5, 4])
+        line, row = chunks[2][1][-1]
+        self.assertEqual(line, 15)
+        self.assertEqual(row["DOB"], "1967-13-04")
+
+    def test_load(self):
+        """ Load the valid rows in parallel and report the rejected ones """
+        rejects = io.StringIO()
+        stats = load(self.uri, [self.path], workers=2, chunk_size=5, rejects=rejects)
+        self.assertEqual((stats.chunks, stats.loaded, stats.rejected), (3, 12, 2))
+        self.assertEqual(self.count("pat"), 12)
+        self.assertEqual(self.count("load_checkpoint"), 3)
+        lines = sorted(rejects.getvalue().splitlines())
+        self.assertEqual(lines, [
+            "{},14,Invalid postal code".format(self.path),
+            "{},15,Invalid date value or format".format(self.path),
+        ])
+        row = self.engine.execute("SELECT block_key FROM pat WHERE lname = 'Buckley'").first()
+        self.assertEqual(row.block_key, "buckley|1952-04-03|904")
+
+    def loaded_keys(self):
+        """ Returns the record keys of the loaded patients, in a list to count duplicates """
+        return sorted(tuple(row) for row in self.engine.execute("SELECT lname, fname FROM pat"))
+
+    def checkpoints(self):
+        return [tuple(row) for row in self.engine.execute(
+            "SELECT chunk, loaded, rejected FROM load_checkpoint ORDER BY chunk")]
+
+    def test_resume(self):
+        """ Load every record exactly once when resuming after a crash """
+        load(self.uri, [self.path], workers=2, chunk_size=5)
+        expected = sorted((record["lname"], record["fname"]) for record in sample_data)
+        self.assertEqual(self.loaded_keys(), expected)
+        self.assertEqual(self.checkpoints(), [(0, 5, 0), (1, 5, 0), (2, 2, 2)])
+        # forget the middle chunk (lines 7 to 11) as if its transaction never committed
+        for record in sample_data[5:10]:
+            self.engine.execute("DELETE FROM pat WHERE lname = ? AND fname = ?", record["lname"], record["fname"])
+        self.engine.execute("DELETE FROM load_checkpoint WHERE chunk = 1")
+        stats = load(self.uri, [self.path], workers=2, chunk_size=5)
+        self.assertEqual((stats.chunks, stats.skipped, stats.loaded), (1, 2, 5))
+        self.assertEqual(self.loaded_keys(), expected)
+        self.assertEqual(self.checkpoints(), [(0, 5, 0), (1, 5, 0), (2, 2, 2)])
+        with self.assertRaises(LoadError):
+            load(self.uri, [self.path], workers=1, chunk_size=4)
@@ -0,0 +1,112 @@
+# License info goes here.
+
+"""
+Test cases for the logging pipeline
+
+Test cases can be run with:
+    nosetests tests/test_logs.py
+"""
+import io
+import json
+import logging
+import unittest
+from flask import request
+from service import app
+from service.models import Pat
+from service.logs import JsonFormatter, SamplingFilter, BackgroundQueueHandler, init_logging, restart_logging
+
+
+######################################################################
+#  LOGGING TEST CASES
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the queued, structured logging """
+
+    def setUp(self):
+        self.handlers = app.logger.handlers
+        self.level = app.logger.level
+        self.output = io.StringIO()
+        app.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        app.logger.handlers = self.handlers
+        app.logger.setLevel(self.level)
+
+    def test_json_lines_with_request_id(self):
+        """ Write JSON lines tagged with the request id from a background thread """
+        listener = init_logging(app, [logging.StreamHandler(self.output)])
+        with app.test_request_context("/pats"):
+            request.request_id = "abc123"
+            app.logger.info("Request for patient with id: %s", 42)
+        app.logger.warning("Outside of a request")
+        listener.stop()
+        lines = [json.loads(line) for line in self.output.getvalue().splitlines()]
+        self.assertEqual(lines[0]["message"], "Request for patient with id: 42")
+        self.assertEqual(lines[0]["request_id"], "abc123")
+        self.assertEqual(lines[0]["level"], "INFO")
+        self.assertEqual(lines[1]["request_id"], "-")
+
+    def test_text_lines(self):
+        """ Write text lines, also for the records of gunicorn that have no request id """
+        handler = logging.StreamHandler(self.output)
+        log_format, app.config["LOG_FORMAT"] = app.config["LOG_FORMAT"], "text"
+        try:
+            listener = init_logging(app, [handler])
+        finally:
+            app.config["LOG_FORMAT"] = log_format
+        app.logger.info("From the app")
+        listener.stop()
+        handler.handle(logging.makeLogRecord({"name": "gunicorn.error", "msg": "Booting worker"}))
+        lines = self.output.getvalue().splitlines()
+        self.assertRegex(lines[0], r"\[INFO\] \[\w+\] \[-\] From the app$")
+        self.assertTrue(lines[1].endswith("[-] Booting worker"))
+
+    def test_restart_logging(self):
+        """ Start a new listener writing to the same handlers after a fork """
+        listener = init_logging(app, [logging.StreamHandler(self.output)])
+        restarted = restart_logging(app)
+        self.assertIsNot(restarted, listener)
+        self.assertIsNot(restarted.queue, listener.queue)
+        self.assertEqual(restarted.handlers, listener.handlers)
+        app.logger.info("From the worker")
+        restarted.stop()
+        self.assertIn("From the worker", self.output.getvalue())
+
+    def test_sampling(self):
+        """ Keep only the sampled INFO lines of a logger """
+        sampler = SamplingFilter({"service.models": 0.0})
+        record = logging.LogRecord("service.models", logging.INFO, __file__, 1, "hi", None, None)
+        self.assertFalse(sampler.filter(record))
+        record.levelno = logging.WARNING
+        self.assertTrue(sampler.filter(record))
+        record = logging.LogRecord("service", logging.INFO, __file__, 1, "hi", None, None)
+        self.assertTrue(sampler.filter(record))
+
+    def test_module_loggers(self):
+        """ Write the lines of the module loggers through the queue, sampled by name """
+        sample_rates = app.config["LOG_SAMPLE_RATES"]
+        listener = init_logging(app, [logging.StreamHandler(self.output)])
+        Pat.find(0)
+        app.config["LOG_SAMPLE_RATES"] = {"service.models": 0.0}
+        try:
+            sampled = init_logging(app, [logging.StreamHandler(self.output)])
+        finally:
+            app.config["LOG_SAMPLE_RATES"] = sample_rates
+        Pat.find(1)
+        app.logger.info("From the app")
+        listener.stop()
+        sampled.stop()
+        lines = [json.loads(line) for line in self.output.getvalue().splitlines()]
+        self.assertEqual([line["message"] for line in lines], ["Processing lookup for id 0 ...", "From the app"])
+        self.assertEqual(lines[0]["logger"], "service.models")
+
+    def test_deferred_formatting(self):
+        """ Format on the listener unless an argument could still change """
+        handler = BackgroundQueueHandler(None)
+        record = logging.LogRecord("service", logging.INFO, __file__, 1, "id %s", (1,), None)
+        self.assertEqual(handler.prepare(record).args, (1,))
+        record = logging.LogRecord("service", logging.INFO, __file__, 1, "list %s", ([1],), None)
+        prepared = handler.prepare(record)
+        self.assertIsNone(prepared.args)
+        self.assertEqual(prepared.msg, "list [1]")
+        self.assertIn('"message": "list [1]"', JsonFormatter().format(prepared))
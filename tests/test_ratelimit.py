@@ -0,0 +1,106 @@
+# License info goes here.
+
+"""
+Test cases for the rate limiter
+
+Test cases can be run with:
+    nosetests tests/test_ratelimit.py
+"""
+import time
+import unittest
+from flask import Flask
+from service.ratelimit import MemoryBackend, RedisBackend, ConcurrencyLimiter, RateLimiter
+
+
+class FakeRedis:
+    """ Stands in for a Redis client, running the token bucket script in Python """
+
+    def __init__(self):
+        self.hashes = {}
+        self.calls = []
+
+    def register_script(self, script):
+        self.script = script
+        return self.run
+
+    def run(self, keys, args):
+        self.calls.append((keys, args))
+        rate, burst, cost, now = (float(arg) for arg in args)
+        bucket = self.hashes.get(keys[0], {})
+        tokens = float(bucket.get("tokens", burst))
+        updated = float(bucket.get("updated", now))
+        tokens = min(burst, tokens + max(0, now - updated) * rate)
+        wait = 0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self.hashes[keys[0]] = {"tokens": str(tokens), "updated": str(now)}
+        return str(wait).encode("ascii")
+
+
+######################################################################
+#  RATE LIMIT TEST CASES
+######################################################################
+class TestRateLimit(unittest.TestCase):
+    """ Test Cases for the token buckets and the concurrency limiter """
+
+    def test_token_bucket(self):
+        """ Admit a burst of requests and then ask for a wait """
+        backend = MemoryBackend()
+        for _ in range(3):
+            self.assertEqual(backend.take("client", rate=1, burst=3), 0)
+        wait = backend.take("client", rate=1, burst=3)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
+        # other keys have a bucket of their own
+        self.assertEqual(backend.take("other", rate=1, burst=3), 0)
+
+    def test_token_bucket_refill(self):
+        """ Refill the bucket as time goes by """
+        backend = MemoryBackend()
+        self.assertEqual(backend.take("client", rate=100, burst=1), 0)
+        self.assertGreater(backend.take("client", rate=100, burst=1), 0)
+        time.sleep(0.05)
+        self.assertEqual(backend.take("client", rate=100, burst=1), 0)
+
+    def test_token_bucket_max_keys(self):
+        """ Forget the least recently seen clients """
+        backend = MemoryBackend(max_keys=2)
+        for key in ["a", "b", "c"]:
+            backend.take(key, rate=1, burst=1)
+        self.assertEqual(list(backend._buckets.keys()), ["b", "c"])
+
+    def test_redis_backend(self):
+        """ Keep the buckets in a shared store under a prefix """
+        client = FakeRedis()
+        backend = RedisBackend(client, prefix="test:")
+        self.assertIn("HMGET", client.script)
+        for _ in range(2):
+            self.assertEqual(backend.take("client", rate=1, burst=2), 0)
+        wait = backend.take("client", rate=1, burst=2)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
+        self.assertEqual(set(client.hashes), {"test:client"})
+        self.assertEqual(client.calls[0][1][:3], [1, 2, 1])
+        # a second worker sharing the store sees the same bucket
+        self.assertGreater(RedisBackend(client, prefix="test:").take("client", rate=1, burst=2), 0)
+
+    def test_storage_uri(self):
+        """ Refuse the storage URIs of no known backend """
+        app = Flask(__name__)
+        app.config["CONCURRENCY_LIMITS"] = {"cheap": 1}
+        app.config["RATE_LIMIT_STORAGE_URI"] = "memory://"
+        self.assertIsInstance(RateLimiter(app).backend, MemoryBackend)
+        app.config["RATE_LIMIT_STORAGE_URI"] = "memcached://localhost"
+        with self.assertRaises(ValueError):
+            RateLimiter(app)
+
+    def test_concurrency_limit(self):
+        """ Cap the requests running at the same time by cost class """
+        limiter = ConcurrencyLimiter({"cheap": 2, "expensive": 1})
+        self.assertTrue(limiter.acquire("expensive"))
+        self.assertFalse(limiter.acquire("expensive"))
+        self.assertTrue(limiter.acquire("cheap"))
+        limiter.release("expensive")
+        self.assertTrue(limiter.acquire("expensive"))
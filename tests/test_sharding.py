@@ -0,0 +1,197 @@
+# License info goes here.
+
+"""
+Test cases for the sharded Pat model
+
+Test cases can be run with:
+    nosetests tests/test_sharding.py
+"""
+import os
+import json
+import base64
+import shutil
+import logging
+import tempfile
+import unittest
+from datetime import datetime
+from service.encryption import keyring
+from service.models import Pat, ArchivedPat, db
+from service.sharding import IdGenerator, ShardSet, WORKER_BITS
+from service import app, archive
+
+with open('tests/records.json') as jsonfile:
+    sample_data = json.load(jsonfile)
+
+DATABASE_URI = os.getenv("DATABASE_URI", "sqlite://")
+KEY_A = ("a", base64.b64encode(b"a" * 32).decode("ascii"))
+KEY_B = ("b", base64.b64encode(b"b" * 32).decode("ascii"))
+
+
+######################################################################
+#  ID GENERATOR TEST CASES
+######################################################################
+class TestIdGenerator(unittest.TestCase):
+    """ Test Cases for the sharded ids """
+
+    def test_ids_are_unique_and_ordered(self):
+        """ Generate increasing ids that remember their shard """
+        ids = IdGenerator(worker=3)
+        generated = [ids.next_id(shard % 4) for shard in range(2000)]
+        self.assertEqual(len(set(generated)), 2000)
+        timestamps = [row_id >> 22 for row_id in generated]
+        self.assertEqual(timestamps, sorted(timestamps))
+        for shard, row_id in enumerate(generated):
+            self.assertEqual(IdGenerator.shard_of(row_id), shard % 4)
+            self.assertLess(row_id, 1 << 63)
+        with self.assertRaises(ValueError):
+            IdGenerator(worker=1 << WORKER_BITS)
+
+    def test_workers_do_not_collide(self):
+        """ Generate different ids in different workers """
+        first, second = IdGenerator(worker=1), IdGenerator(worker=2)
+        self.assertNotEqual(first.next_id(0), second.next_id(0))
+
+    def test_worker_required(self):
+        """ Refuse to shard without a worker number """
+        with self.assertRaises(ValueError):
+            ShardSet(["sqlite://"], None)
+
+
+######################################################################
+#  SHARDED MODEL TEST CASES
+######################################################################
+class TestShardedPatModel(unittest.TestCase):
+    """ Test Cases for the Pat model spread over two SQLite shards """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Pat.init_db(app)
+        cls.tmpdir = tempfile.mkdtemp()
+        uris = ["sqlite:///" + os.path.join(cls.tmpdir, "shard{}.db".format(i)) for i in range(2)]
+        Pat.shards = ShardSet(
+            uris,
+            5,
+            strategy="state",
+            states={"CA": 0, "California": 1},
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        Pat.shards.dispose()
+        Pat.shards = None
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        Pat.shards.create_all([Pat.__table__, ArchivedPat.__table__])
+        self.pats = []
+        for record in sample_data:
+            pat = Pat().deserialize(record)
+            pat.create()
+            self.pats.append(pat)
+
+    def tearDown(self):
+        Pat.shards.remove()
+        Pat.shards.drop_all([Pat.__table__, ArchivedPat.__table__])
+
+    def test_patients_placed_by_state(self):
+        """ Store every patient on the shard of its state """
+        counts = [engine.execute("SELECT COUNT(*) FROM pat").scalar() for engine in Pat.shards.engines]
+        self.assertEqual(counts, [11, 1])
+        for pat in self.pats:
+            self.assertEqual(IdGenerator.shard_of(pat.id), 1 if pat.state == "California" else 0)
+        # nothing is written to the unsharded database
+        self.assertEqual(db.session.query(Pat).count(), 0)
+
+    def test_find_routes_by_id(self):
+        """ Find a patient on the shard recorded in its id """
+        pat = Pat.find(self.pats[10].id)
+        self.assertEqual(pat.lname, "Buckley")
+        self.assertIsNone(Pat.find(0))
+        found = Pat.find_many([self.pats[10].id, self.pats[0].id, 12345])
+        self.assertEqual(sorted(found.keys()), sorted([self.pats[10].id, self.pats[0].id]))
+
+    def test_scatter_gather(self):
+        """ Query every shard and merge the patients by id """
+        pats = Pat.all()
+        self.assertEqual([pat.id for pat in pats], sorted(pat.id for pat in self.pats))
+        pats = Pat.find_by_lname("Perez", Pat.parse_fields("fname"))
+        self.assertEqual([pat.fname for pat in pats], ["Eduardo", "Brent"])
+        self.assertEqual(len(Pat.find_by_state("California")), 1)
+
+    def test_dob_range_across_shards(self):
+        """ Merge the pages of every shard in DOB order """
+        pats = Pat.find_by_dob_range(datetime(1950, 1, 1), datetime(1959, 12, 31), limit=2)
+        self.assertEqual([pat.DOB.year for pat in pats], [1952, 1955])
+        self.assertEqual(IdGenerator.shard_of(pats[0].id), 1)
+        pats = Pat.find_by_dob_range(datetime(1950, 1, 1), after=(pats[-1].DOB, pats[-1].id), limit=2)
+        self.assertEqual([pat.DOB.year for pat in pats], [1957, 1960])
+
+    def test_update_and_delete(self):
+        """ Update and delete a patient on its shard """
+        pat_id = self.pats[10].id
+        pat = Pat.find(pat_id)
+        pat.city = "Malibu"
+        pat.save()
+        Pat.shards.remove()
+        self.assertEqual(Pat.find(pat_id).city, "Malibu")
+        Pat.find(pat_id).delete()
+        self.assertIsNone(Pat.find(pat_id))
+        self.assertEqual(len(Pat.all()), 11)
+        self.assertEqual(archive.run(0, batch_size=5, sleep=0), 1)
+        self.assertEqual(Pat.find(pat_id, include_archived=True).city, "Malibu")
+        self.assertEqual(len(Pat.all(include_archived=True)), 12)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_after_fork(self):
+        """ Query the shards from a forked worker with ids of its own """
+        self.assertEqual(len(Pat.all()), 12)  # the query threads are running
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Pat.shards.after_fork(7)
+                result = "{},{}".format(len(Pat.all()), Pat.shards.ids.worker == 7)
+                os.write(write, result.encode("ascii"))
+            finally:
+                os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        with os.fdopen(read) as pipe:
+            self.assertEqual(pipe.read(), "12,True")
+        self.assertEqual(Pat.shards.ids.worker, 5)
+
+    def test_blocks_across_shards(self):
+        """ Merge the blocks of every shard in blocking key order """
+        twin = Pat().deserialize(dict(sample_data[10], fname="Bert", state="CA"))
+        twin.create()
+        blocks = list(Pat.blocks(batch_size=3))
+        keys = [key for key, _ in blocks]
+        self.assertEqual(keys, sorted(set(keys)))
+        block = dict(blocks)[twin.block_key]
+        self.assertEqual(sorted(pat.id for pat in block), sorted([self.pats[10].id, twin.id]))
+
+    def test_encrypted_blocks_across_shards(self):
+        """ Merge the blocks of every shard with the keys in plaintext and under several keys """
+        self.addCleanup(keyring.configure, app.config["FIELD_ENCRYPTION_KEYS"])
+        keyring.configure([KEY_A])
+        twins = [Pat().deserialize(dict(sample_data[10], fname="Bert", state=state)) for state in ("CA", "California")]
+        for twin in twins:
+            twin.create()
+        keyring.configure([KEY_B, KEY_A])
+        for i, record in enumerate(sample_data):
+            Pat().deserialize(dict(record, fname="Copy", state=("CA", "California")[i % 2])).create()
+        blocks = list(Pat.blocks(batch_size=3))
+        keys = [key for key, _ in blocks]
+        self.assertEqual(sorted(keys), sorted(set(pat.block_key for pat in self.pats)))
+        for key, pats in blocks:
+            originals = [pat.id for pat in self.pats if pat.block_key == key]
+            self.assertEqual(sum(pat.fname == "Copy" for pat in pats), len(originals))
+            self.assertTrue(set(originals) <= set(pat.id for pat in pats))
+        block = dict(blocks)[self.pats[10].block_key]
+        self.assertEqual(len(block), 4)
+        self.assertTrue(set(twin.id for twin in twins) <= set(pat.id for pat in block))
@@ -0,0 +1,84 @@
+# License info goes here.
+
+"""
+Test cases for the request coalescing
+
+Test cases can be run with:
+    nosetests tests/test_singleflight.py
+"""
+import time
+import threading
+import unittest
+from service.singleflight import SingleFlight
+
+
+######################################################################
+#  SINGLE FLIGHT TEST CASES
+######################################################################
+class TestSingleFlight(unittest.TestCase):
+    """ Test Cases for folding identical concurrent calls """
+
+    def run_concurrently(self, flight, key, load, count):
+        """ Calls flight.do from several threads once the first call is in flight """
+        results = [None] * count
+        errors = [None] * count
+
+        def call(index):
+            try:
+                results[index] = flight.do(key, load)
+            except Exception as error:
+                errors[index] = error
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+        threads[0].start()
+        while not flight.stats()["in_flight"]:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        # the waiters have joined once they are counted
+        while flight.stats()["coalesced"] < count - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        self.release.wait()
+        return [{"id": 1}]
+
+    def test_coalesce(self):
+        """ Share the result of a call in flight with the identical calls """
+        flight = SingleFlight()
+        results, errors = self.run_concurrently(flight, ("records", "/pats"), self.load, 5)
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(results, [[{"id": 1}]] * 5)
+        self.assertIs(results[0], results[4])
+        self.assertEqual(errors, [None] * 5)
+        self.assertEqual(flight.stats(), {"calls": 1, "coalesced": 4, "in_flight": 0})
+        # a call that starts once the first is done reads again
+        self.assertEqual(flight.do(("records", "/pats"), lambda: []), [])
+        self.assertEqual(flight.stats()["calls"], 2)
+
+    def test_other_keys(self):
+        """ Run the calls of other keys on their own """
+        flight = SingleFlight()
+        self.assertEqual(flight.do("a", lambda: 1), 1)
+        self.assertEqual(flight.do("b", lambda: 2), 2)
+        self.assertEqual(flight.stats(), {"calls": 2, "coalesced": 0, "in_flight": 0})
+
+    def test_error(self):
+        """ Raise the error of the call in flight in every waiter """
+        def fail():
+            self.release.wait()
+            raise ValueError("database is down")
+        flight = SingleFlight()
+        results, errors = self.run_concurrently(flight, "key", fail, 3)
+        self.assertEqual(results, [None] * 3)
+        self.assertTrue(all(isinstance(error, ValueError) for error in errors))
+        self.assertEqual(flight.stats()["in_flight"], 0)